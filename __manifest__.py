@@ -6,10 +6,15 @@
     'description': """Wompi Colombia payment acquirer""",
     'depends': ['payment'],
     'data': [
+        'security/ir.model.access.csv',
+        'views/payment_wompicol_event_views.xml',
+        'views/payment_wompicol_reconciliation_views.xml',
+        'views/payment_wompicol_settlement_views.xml',
         'views/payment_views.xml',
         'views/payment_wompicol_templates.xml',
         'views/template_modify.xml',
         'data/payment_acquirer_data.xml',
+        'data/ir_cron_data.xml',
     ],
     'post_init_hook': 'create_missing_journal_for_acquirers',
 }
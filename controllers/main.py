@@ -1,12 +1,16 @@
 import logging
-import pprint
 import werkzeug
 import json
+import hmac
+import time
 
 from odoo import http
 from odoo.http import request
 from odoo.http import Response
 from odoo.addons.payment.models.payment_acquirer import ValidationError
+from odoo.addons.payment_wompicol.models import wompicol_logging, wompicol_metrics
+from odoo.addons.payment_wompicol.models.wompicol_client import CircuitOpenError
+from odoo.addons.payment_wompicol.models.wompicol_event import RetryableEventError
 
 _logger = logging.getLogger(__name__)
 
@@ -14,9 +18,11 @@ _logger = logging.getLogger(__name__)
 class WompiColController(http.Controller):
 
     @http.route(['/payment/wompicol/response',
-                '/payment/wompicol_test/response'],
+                '/payment/wompicol_test/response',
+                '/payment/wompicol/<int:acquirer_id>/response',
+                '/payment/wompicol_test/<int:acquirer_id>/response'],
                 type='json', auth='public', csrf=False)
-    def wompicol_response(self):
+    def wompicol_response(self, acquirer_id=None, **kwargs):
         """ Wompi Colombia """
         # Wompi servers will post the event information
         # {
@@ -43,33 +49,69 @@ class WompiColController(http.Controller):
             # If entered on the test endpoint, let's add it to the data
             if 'wompicol_test' in request.httprequest.path:
                 post["test"] = 1
+            # When it was received, for the freshness of its timestamp
+            post["received_at"] = int(time.time())
 
             # Log the event data
             _logger.info(
                 'Wompicol: entering form_feedback with post response data %s',
-                pprint.pformat(post))
-
-            ref = post.get('data', {}).get('transaction', {}).get('reference', {})
-            if '_' in ref:
-                post['data']['transaction']['reference'] = ref.split('_')[0]
+                wompicol_logging.payload(post, wompicol_logging.sample_rate(request.env)))
 
             if post.get('noconfirm'):
                 raise ValidationError('Wompicol: should not receive "noconfirm" on the controller')
 
-            # Process the data
-            request.env['payment.transaction'].sudo().form_feedback(
-                    post,
-                    'wompicol')
+            # The url of each acquirer only updates its transactions
+            acquirer = request.env['payment.acquirer'].sudo()._wompicol_get_acquirer(acquirer_id)
+            if not acquirer:
+                _logger.warning('Wompicol: event received for unknown acquirer %s', acquirer_id)
+                return werkzeug.utils.redirect('/')
+            if acquirer_id:
+                post["acquirer_id"] = acquirer.id
+
+            wompicol_metrics.inc(
+                    'wompicol_events_total', source='webhook',
+                    status=post.get('data', {}).get('transaction', {}).get('status'))
+
+            # Wompi delivers the same event more than once
+            if not request.env['payment.wompicol.dedup'].sudo()._wompicol_register_event(post):
+                _logger.info('Wompicol: dropping already received event')
+                return werkzeug.utils.redirect('/')
+
+            if acquirer.wompicol_async_events:
+                # Only store it, the queue cron takes care of the rest
+                request.env['payment.wompicol.event'].sudo()._wompicol_enqueue(
+                        post, acquirer)
+            else:
+                # Process the data, if wompi api is down and it's needed
+                # to verify the event, defer it to the queue.
+                try:
+                    with request.env.cr.savepoint():
+                        request.env['payment.transaction'].sudo().form_feedback(
+                                post,
+                                'wompicol')
+                    if acquirer.wompicol_record_events:
+                        request.env['payment.wompicol.event'].sudo()._wompicol_record(
+                                post, acquirer)
+                except CircuitOpenError as e:
+                    _logger.info('Wompicol: wompi api unavailable, deferring event')
+                    request.env['payment.wompicol.event'].sudo()._wompicol_enqueue(
+                            post, acquirer, error=str(e))
+                except RetryableEventError as e:
+                    # Keep it to be retried, instead of losing it
+                    _logger.info('Wompicol: event failed, scheduling retry: %s', e)
+                    request.env['payment.wompicol.event'].sudo()._wompicol_enqueue(
+                            post, acquirer)._wompicol_failed(str(e))
         else:
             _logger.info(
                 'Wompicol: for feedback entered with incomplete data %s',
-                pprint.pformat(post))
+                wompicol_logging.dump(post))
 
         return werkzeug.utils.redirect('/')
 
-    @http.route('/payment/wompicol/client_return', type='http',
-                auth='public', csrf=False)
-    def wompicol_client_return(self, **post):
+    @http.route(['/payment/wompicol/client_return',
+                 '/payment/wompicol/<int:acquirer_id>/client_return'],
+                type='http', auth='public', csrf=False)
+    def wompicol_client_return(self, acquirer_id=None, **post):
         """ Wompi Colombia """
         # The client browser will comeback with the following data
         # {
@@ -77,15 +119,112 @@ class WompiColController(http.Controller):
         #   'id': '16056-1597266116-33603'
         # }
 
-        _logger.info('Wompicol: client browser returning. %s',
-                     pprint.pformat(post))
+        _logger.info('Wompicol: client browser returning with id: %s env: %s',
+                     post.get('id'), post.get('env'))
         if post:
             id = post.get('id')
             env = post.get('env')
             env = env if env == 'test' else 'prod'
-            # Process the data
+            # Process the data, without making the client wait for it,
+            # /payment/process polls until the transaction is updated.
             request.env[
                     'payment.transaction'
-                    ].sudo()._wompicol_get_data_manually(id, env)
+                    ].sudo()._wompicol_schedule_data_manually(id, env, acquirer_id)
 
         return werkzeug.utils.redirect('/payment/process')
+
+    @http.route('/payment/wompicol/widget_return', type='json',
+                auth='public', csrf=False)
+    def wompicol_widget_return(self, id=None, env=None, acquirer_id=None, **kwargs):
+        """ Wompi Colombia """
+        # The widget callback sends the wompi id of the transaction,
+        # the browser then polls the status until it's updated.
+        _logger.info('Wompicol: widget returning with id: %s env: %s', id, env)
+        if not id:
+            return False
+        if acquirer_id and not str(acquirer_id).isdigit():
+            # Not sent by the widget, ignored as an invalid id is
+            return False
+        env = env if env == 'test' else 'prod'
+        request.env[
+                'payment.transaction'
+                ].sudo()._wompicol_schedule_data_manually(
+                        id, env, int(acquirer_id) if acquirer_id else None)
+        return True
+
+    @http.route('/payment/wompicol/status/<string:reference>', type='http',
+                auth='public', csrf=False)
+    def wompicol_status(self, reference, **kwargs):
+        """ State of a transaction of the session, to be polled by the
+        browser, answers 304 if it didn't change since the ETag sent."""
+        tx_status = request.env[
+                'payment.transaction'
+                ].sudo()._wompicol_get_status(reference)
+        tx_ids = request.session.get('__payment_tx_ids__', [])
+        if not tx_status or tx_status['id'] not in tx_ids:
+            return request.not_found()
+
+        etag = tx_status.pop('etag')
+        headers = [('ETag', f'"{etag}"'), ('Cache-Control', 'no-cache')]
+        if etag in request.httprequest.if_none_match:
+            return Response(status=304, headers=headers)
+        headers.append(('Content-Type', 'application/json'))
+        return request.make_response(json.dumps(tx_status), headers=headers)
+
+    def _wompicol_check_token(self, param, token=None):
+        """ Whether the token, given or sent as bearer, matches the
+        system parameter, never if the parameter isn't set."""
+        expected = request.env['ir.config_parameter'].sudo().get_param(param)
+        auth = request.httprequest.headers.get('Authorization', '')
+        token = token or (auth[7:] if auth.startswith('Bearer ') else None)
+        return bool(expected and token and hmac.compare_digest(token, expected))
+
+    @http.route(['/payment/wompicol/batch',
+                 '/payment/wompicol/<int:acquirer_id>/batch'],
+                type='http', methods=['POST'], auth='public', csrf=False)
+    def wompicol_batch(self, acquirer_id=None, **kwargs):
+        """ List of wompi events to process at once, when re-driving
+        or replaying them, only when the bearer token matches the
+        payment_wompicol.batch_token system parameter. Events from
+        the test environment carry "environment": "test". Events
+        replayed from the history carry the "received_at" unix time
+        they were first received at, their signed timestamp is checked
+        against it, else against now."""
+        if not self._wompicol_check_token('payment_wompicol.batch_token'):
+            return request.not_found()
+        if acquirer_id and not request.env['payment.acquirer'].sudo()._wompicol_get_acquirer(acquirer_id):
+            return request.not_found()
+        try:
+            events = json.loads(request.httprequest.data)
+        except ValueError:
+            events = None
+        if not isinstance(events, list):
+            return Response('Expected a list of events', status=400)
+        for event in events:
+            if isinstance(event, dict):
+                if event.get('noconfirm'):
+                    return Response('Events can not carry "noconfirm"', status=400)
+                received_at = event.get('received_at')
+                if received_at is not None and (isinstance(received_at, bool)
+                                                or not isinstance(received_at, (int, float))):
+                    return Response('"received_at" must be a unix time', status=400)
+                if event.get('environment') == 'test':
+                    event['test'] = 1
+                if acquirer_id:
+                    event['acquirer_id'] = acquirer_id
+        result = request.env['payment.transaction'].sudo()._wompicol_form_feedback_batch(events)
+        return request.make_response(
+                json.dumps(result),
+                headers=[('Content-Type', 'application/json')])
+
+    @http.route('/payment/wompicol/metrics', type='http',
+                auth='public', csrf=False)
+    def wompicol_metrics(self, token=None, **kwargs):
+        """ Metrics of the process in prometheus text format, only
+        when the token matches the payment_wompicol.metrics_token
+        system parameter."""
+        if not self._wompicol_check_token('payment_wompicol.metrics_token', token):
+            return request.not_found()
+        return request.make_response(
+                wompicol_metrics.render(),
+                headers=[('Content-Type', 'text/plain; version=0.0.4')])
@@ -1 +1,5 @@
 from . import payment
+from . import wompicol_event
+from . import wompicol_dedup
+from . import wompicol_reconciliation
+from . import wompicol_settlement
@@ -2,17 +2,29 @@ import logging
 import uuid
 import math
 import requests
-import pprint
 import time
 import random
+import hmac
+import copy
+import threading
+import datetime
+import itertools
 
-from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor
+
+from hashlib import md5, sha256
 from werkzeug import urls
 
-from odoo import api, fields, models, _
+import odoo
+from odoo import api, fields, models, tools, SUPERUSER_ID, _
 from odoo.addons.payment.models.payment_acquirer import ValidationError
 from odoo.tools.float_utils import float_compare
 
+from . import wompicol_client
+from . import wompicol_logging
+from . import wompicol_metrics
+from .wompicol_event import TransactionLockedError, TransactionNotFoundError, EventNotVerifiedError, WOMPI_ID
+
 
 _logger = logging.getLogger(__name__)
 
@@ -60,31 +72,159 @@ class PaymentAcquirerWompicol(models.Model):
             store=False,
             compute='_wompicol_event_url'
             )
+    wompicol_events_secret = fields.Char(
+            string="Wompi Colombia Events Secret",
+            groups='base.group_user'
+            )
+    wompicol_test_events_secret = fields.Char(
+            string="Wompi Colombia Test Events Secret",
+            groups='base.group_user'
+            )
+    wompicol_event_verification = fields.Selection([
+            ('signature', 'Event Signature'),
+            ('api', 'Wompi API')],
+            string="Wompi Colombia Event Verification",
+            default='signature',
+            help="Signature: check the checksum of the event with the "
+                 "events secret, no call to wompi is needed. Wompi API: "
+                 "ask wompi for the transaction and compare. When no "
+                 "events secret is set the api is used.",
+            groups='base.group_user'
+            )
+    wompicol_async_events = fields.Boolean(
+            string="Wompi Colombia Process Events Asynchronously",
+            help="Only store the events received from wompi and answer "
+                 "right away, the events are processed later by a cron.",
+            groups='base.group_user'
+            )
+    wompicol_payment_mode = fields.Selection([
+            ('redirect', 'Redirect to Wompi Checkout'),
+            ('widget', 'Wompi Widget')],
+            string="Wompi Colombia Payment Mode",
+            default='redirect',
+            help="Redirect the customer to the wompi checkout, or open the "
+                 "wompi widget on the payment page.",
+            groups='base.group_user'
+            )
+    wompicol_record_events = fields.Boolean(
+            string="Wompi Colombia Record Events",
+            help="Also keep the events processed right away, so every "
+                 "event received can be replayed later.",
+            groups='base.group_user'
+            )
 
     def _wompicol_event_url(self):
         """Set the urls to config in the wompi console"""
-        prod_url = ''
-        test_url = ''
-        if self.provider == 'wompicol':
-            base_url = self.env[
-                    'ir.config_parameter'
-                    ].sudo().get_param('web.base.url')
-            prod_url = f"{base_url}/payment/wompicol/response"
-            test_url = f"{base_url}/payment/wompicol_test/response"
-
-        self.wompicol_event_url = prod_url
-        self.wompicol_test_event_url = test_url
+        for acquirer in self:
+            prod_url = ''
+            test_url = ''
+            if acquirer.provider == 'wompicol':
+                base_url = acquirer._wompicol_config()['base_url']
+                prod_url = f"{base_url}/payment/wompicol/{acquirer.id}/response"
+                test_url = f"{base_url}/payment/wompicol_test/{acquirer.id}/response"
+
+            acquirer.wompicol_event_url = prod_url
+            acquirer.wompicol_test_event_url = test_url
+
+    @tools.ormcache('self.id', 'self.env.company.id')
+    def _wompicol_config(self):
+        """Snapshot of the configuration of the acquirer, cached until
+        the acquirer or a system parameter is written, do not modify
+        the returned value."""
+        self.ensure_one()
+        acquirer = self.sudo()
+        return {
+            'base_url': self.env['ir.config_parameter'].sudo().get_param('web.base.url'),
+            'environment': 'prod' if acquirer.state == 'enabled' else 'test',
+            'prod': {
+                'keys': (acquirer.wompicol_private_key, acquirer.wompicol_public_key),
+                'events_secret': acquirer.wompicol_events_secret,
+            },
+            'test': {
+                'keys': (acquirer.wompicol_test_private_key, acquirer.wompicol_test_public_key),
+                'events_secret': acquirer.wompicol_test_events_secret,
+            },
+        }
+
+    @api.model
+    @tools.ormcache()
+    def _wompicol_acquirer_ids(self):
+        """Ids of the wompicol acquirers, cached until one of them is
+        created, written or deleted."""
+        return tuple(self.sudo().search([('provider', '=', 'wompicol')]).ids)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        acquirers = super(PaymentAcquirerWompicol, self).create(vals_list)
+        if any(acquirer.provider == 'wompicol' for acquirer in acquirers):
+            self.clear_caches()
+        return acquirers
+
+    def write(self, vals):
+        res = super(PaymentAcquirerWompicol, self).write(vals)
+        if any(acquirer.provider == 'wompicol' for acquirer in self) \
+           or vals.get('provider') == 'wompicol':
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        wompicol = any(acquirer.provider == 'wompicol' for acquirer in self)
+        res = super(PaymentAcquirerWompicol, self).unlink()
+        if wompicol:
+            self.clear_caches()
+        return res
+
+    def _get_wompicol_client(self, environment=None):
+        """Shared http client of the process for the environment,
+        every call to the wompi api should go through it."""
+        if not environment:
+            environment = 'prod' if self.state == 'enabled' else 'test'
+        return wompicol_client.get_client(environment)
 
     def _get_wompicol_api_url(self, environment=None):
         """This method should be called to get the api
         url to query depending on the environment."""
-        if not environment:
-            environment = 'prod' if self.state == 'enabled' else 'test'
+        return self._get_wompicol_client(environment).base_url
 
-        if environment == 'prod':
-            return 'https://production.wompi.co/v1'
-        else:
-            return 'https://sandbox.wompi.co/v1'
+    def _wompicol_get_transaction(self, wompi_id, environment=None, status=None):
+        """The wompi transaction data from the api, through the lookup
+        cache of the process, the caller is free to modify it."""
+        return copy.deepcopy(self._get_wompicol_client(
+            environment).get_transaction(wompi_id, status))
+
+    def _get_wompicol_rate_limiter(self, environment=None):
+        """Rate limiter of the process for the merchant of the acquirer,
+        to the payment_wompicol.rate_limit calls per second."""
+        rate = float(self.env['ir.config_parameter'].sudo().get_param(
+                'payment_wompicol.rate_limit', 10))
+        environment = environment or self._wompicol_config()['environment']
+        return wompicol_client.get_rate_limiter(
+                (environment, self._get_keys(environment)[1]), rate)
+
+    def _wompicol_get_acceptance(self, environment=None):
+        """The presigned acceptance of the merchant, needed to create
+        transactions through the api, shared by the process until
+        shortly before it expires."""
+        public_key = self._get_keys(environment)[1]
+        return dict(self._get_wompicol_client(environment).get_acceptance(public_key))
+
+    def _wompicol_new_reference(self, reference):
+        """A new wompi reference for the odoo reference, wompi doesn't
+        accept the same one twice. The events come with it, it's kept
+        to find the transaction."""
+        wompiref = f"{reference}_{int(random.random() * 1000)}"
+        self.env['payment.transaction']._wompicol_set_reference(reference, wompiref)
+        return wompiref
+
+    @api.model
+    def _wompicol_get_acquirer(self, acquirer_id=None):
+        """The wompicol acquirer with the id, empty if there's none,
+        without one the first wompicol acquirer, the one that receives
+        the events of the urls without acquirer."""
+        acquirer_ids = self._wompicol_acquirer_ids()
+        if acquirer_id:
+            return self.browse(acquirer_id if acquirer_id in acquirer_ids else [])
+        return self.browse(acquirer_ids[:1])
 
     def _get_wompicol_urls(self):
         """ Wompi Colombia URLs this method should be called to
@@ -95,27 +235,18 @@ class PaymentAcquirerWompicol(models.Model):
         """Wompi keys change wether is prod or test
         returns a tuple with (pub, prod) dending on
         environment return the appropiate key."""
-        if not environment:
-            environment = 'prod' if self.state == 'enabled' else 'test'
+        config = self._wompicol_config()
+        return config[environment or config['environment']]['keys']
 
-        if environment == 'prod':
-            prv = self.wompicol_private_key
-            pub = self.wompicol_public_key
-            return(prv, pub)
-        else:
-            test_prv = self.wompicol_test_private_key
-            test_pub = self.wompicol_test_public_key
-            return(test_prv, test_pub)
+    def _get_wompicol_events_secret(self, environment=None):
+        """The secret wompi uses to sign the events of the environment."""
+        config = self._wompicol_config()
+        return config[environment or config['environment']]['events_secret']
 
     def wompicol_form_generate_values(self, values):
+        config = self._wompicol_config()
         # The base url
-        base_url = self.env[
-                'ir.config_parameter'
-                ].sudo().get_param('web.base.url')
-        # Get the payment transaction
-        tx = self.env[
-                'payment.transaction'
-                ].search([('reference', '=', values.get('reference'))])
+        base_url = config['base_url']
 
         if values['currency'].name != 'COP':
             error_msg = (
@@ -123,19 +254,63 @@ class PaymentAcquirerWompicol(models.Model):
                 % (values['currency'].name))
             raise ValidationError(error_msg)
 
-        wompiref = f"{tx.reference}_{int(random.random() * 1000)}"
+        wompiref = self._wompicol_new_reference(values['reference'])
 
         wompicol_tx_values = dict(
             values,
-            publickey=self._get_keys()[1],
+            publickey=config[config['environment']]['keys'][1],
             currency='COP',
             # Wompi wants cents (*100) and has to end on 00.
             amountcents=math.ceil(values['amount']) * 100,
             referenceCode=wompiref,
-            redirectUrl=urls.url_join(base_url, '/payment/wompicol/client_return'),
+            redirectUrl=urls.url_join(base_url, f'/payment/wompicol/{self.id}/client_return'),
+            wompicolMode=self.wompicol_payment_mode or 'redirect',
+            wompicolEnv=config['environment'],
+            wompicolAcquirerId=self.id,
         )
         return wompicol_tx_values
 
+    def wompicol_s2s_form_validate(self, data):
+        return bool(data.get('payment_source_id') or data.get('wompicol_token'))
+
+    def wompicol_s2s_form_process(self, data):
+        """Save a wompi payment source as a payment.token, the one with
+        payment_source_id, or a new one created from the wompicol_token
+        of a card tokenized with the public key. The payment source id
+        is what's charged later."""
+        self.ensure_one()
+        partner = self.env['res.partner'].browse(int(data['partner_id']))
+        source_id = data.get('payment_source_id')
+        name = data.get('name')
+        if not source_id:
+            source = self._get_wompicol_client().create_payment_source(self._get_keys()[0], {
+                'type': data.get('wompicol_type') or 'CARD',
+                'token': data['wompicol_token'],
+                'customer_email': data.get('customer_email') or partner.email,
+                'acceptance_token': self._wompicol_get_acceptance()['acceptance_token'],
+            })
+            source_id = source.get('id')
+            public_data = source.get('public_data') or {}
+            if not name and public_data.get('last_four'):
+                name = 'XXXXXXXXXXXX%s' % public_data['last_four']
+        return self.env['payment.token'].sudo().create({
+            'name': name or 'Wompi %s' % source_id,
+            'acquirer_ref': str(source_id),
+            'acquirer_id': self.id,
+            'partner_id': partner.id,
+        })
+
+    def wompicol_import_settlement(self, fileobj, filename):
+        """Import the wompi settlement or payout csv export read from the
+        binary file object, returns the payment.wompicol.settlement."""
+        self.ensure_one()
+        settlement = self.env['payment.wompicol.settlement'].create({
+            'name': filename,
+            'acquirer_id': self.id,
+        })
+        settlement._wompicol_import(fileobj)
+        return settlement
+
     def wompicol_get_form_action_url(self):
         '''This method gets called by odoo and should return the url
         of to action the form data on button press'''
@@ -146,48 +321,306 @@ class PaymentAcquirerWompicol(models.Model):
 class PaymentTransactionWompiCol(models.Model):
     _inherit = 'payment.transaction'
 
-    def _wompicol_get_data_manually(self, id, environment):
+    # The reference sent to wompi, odoo reference plus a random suffix
+    wompicol_reference = fields.Char(
+            string="Wompi Colombia Reference",
+            index=True,
+            readonly=True,
+            copy=False
+            )
+    # Backoff of the reconciliation of transactions stuck in pending
+    wompicol_next_check = fields.Datetime(
+            string="Wompi Colombia Next Check",
+            index=True,
+            readonly=True
+            )
+    wompicol_check_count = fields.Integer(
+            string="Wompi Colombia Checks",
+            readonly=True
+            )
+    # sent_at of the last event applied, older ones are skipped
+    wompicol_event_date = fields.Char(
+            string="Wompi Colombia Last Event",
+            readonly=True,
+            copy=False
+            )
+    # Voided in wompi, the state is kept, the payment is reversed in odoo
+    wompicol_voided = fields.Boolean(
+            string="Voided in Wompi Colombia",
+            readonly=True,
+            copy=False
+            )
+
+    def init(self):
+        super(PaymentTransactionWompiCol, self).init()
+        # Lookups by wompi id, only for wompicol transactions
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS payment_transaction_wompicol_acquirer_reference_index
+            ON payment_transaction (acquirer_reference)
+            WHERE wompicol_reference IS NOT NULL
+        """)
+
+    @api.model
+    def form_feedback(self, data, acquirer_name):
+        if acquirer_name != 'wompicol':
+            return super(PaymentTransactionWompiCol, self).form_feedback(data, acquirer_name)
+        # Profile a sample of the events if set up
+        sample_rate = float(self.env['ir.config_parameter'].sudo().get_param(
+                'payment_wompicol.profile_sample_rate', 0))
+        with wompicol_metrics.profile('form_feedback', sample_rate), \
+                wompicol_metrics.span('form_feedback'):
+            try:
+                return super(PaymentTransactionWompiCol, self).form_feedback(data, acquirer_name)
+            except ValidationError as e:
+                # Only on failure the whole payload is worth the log
+                _logger.warning('Wompicol: validation failed: %s for data %s',
+                                e, wompicol_logging.dump(data))
+                raise
+
+    def _wompicol_lock(self):
+        """Lock the rows of the transactions until the end of the database
+        transaction, returns the ones locked, the others are held by
+        another one."""
+        if not self:
+            return self
+        self.env.cr.execute("""
+            SELECT id FROM payment_transaction
+            WHERE id IN %s
+            FOR UPDATE SKIP LOCKED
+        """, (tuple(self.ids),))
+        locked = self.browse([row[0] for row in self.env.cr.fetchall()])
+        # Read what the previous holder of the lock wrote
+        self.invalidate_cache(['state', 'is_processed', 'acquirer_reference', 'wompicol_event_date'],
+                              locked.ids)
+        return locked
+
+    def wompicol_api_create(self, payment_method, customer_email=None):
+        """Create the transaction in wompi through the api, payment_method
+        as wompi expects it, e.g. {'type': 'NEQUI', 'phone_number': ...}
+        or {'type': 'CARD', 'token': ..., 'installments': 1}. The status
+        wompi answers with is applied right away, the final one comes as
+        an event. Returns the wompi transaction data."""
+        self.ensure_one()
+        acquirer = self.acquirer_id
+        if self.currency_id.name != 'COP':
+            raise ValidationError(_('WompiCol: Only accepts COP as the currency, received %s') % self.currency_id.name)
+        config = acquirer._wompicol_config()
+        private_key = acquirer._get_keys()[0]
+        values = {
+            'acceptance_token': acquirer._wompicol_get_acceptance()['acceptance_token'],
+            # Wompi wants cents (*100) and has to end on 00.
+            'amount_in_cents': math.ceil(self.amount) * 100,
+            'currency': 'COP',
+            'customer_email': customer_email or self.partner_email,
+            'reference': acquirer._wompicol_new_reference(self.reference),
+            'payment_method': payment_method,
+            'redirect_url': urls.url_join(config['base_url'], f'/payment/wompicol/{acquirer.id}/client_return'),
+        }
+        with wompicol_metrics.span('create_transaction'):
+            wompi_data = acquirer._get_wompicol_client().create_transaction(private_key, values)
+        _logger.info('Wompicol: transaction created through the api %s',
+                     wompicol_logging.payload(wompi_data, wompicol_logging.sample_rate(self.env)))
+        data = {'data': {'transaction': wompi_data}, 'noconfirm': True}
+        if config['environment'] == 'test':
+            data['test'] = True
+        self.form_feedback(data, 'wompicol')
+        return wompi_data
+
+    @api.model
+    def _wompicol_set_reference(self, reference, wompi_reference):
+        """Store the wompi reference of the transaction with the odoo
+        reference, with a single update."""
+        self.env.cr.execute("""
+            UPDATE payment_transaction SET wompicol_reference = %s
+            WHERE reference = %s
+        """, (wompi_reference, reference))
+        self.invalidate_cache(['wompicol_reference'])
+
+    @api.model
+    def _wompicol_get_status(self, reference):
+        """The state of the transaction with the reference, read with a
+        single query, with an etag that changes on every write."""
+        # Writes are kept by the orm until flushed, the query must see them
+        self.flush(['state', 'write_date'])
+        self.env.cr.execute("""
+            SELECT id, state, write_date FROM payment_transaction
+            WHERE reference = %s
+        """, (reference,))
+        row = self.env.cr.fetchone()
+        if not row:
+            return None
+        tx_id, state, write_date = row
+        etag = md5(f"{tx_id}-{state}-{write_date}".encode()).hexdigest()
+        return {'id': tx_id, 'reference': reference, 'state': state, 'etag': etag}
+
+    @api.model
+    def _wompicol_schedule_data_manually(self, id, environment, acquirer_id=None):
+        """Queue the lookup of the transaction the client came back
+        with, run by one of the bounded lookup threads of the process
+        once committed, or by the queue cron if they are busy or the
+        worker goes away."""
+        if not id or not WOMPI_ID.match(id):
+            _logger.info('Wompicol: ignoring client return with invalid id %r', id)
+            return
+        acquirer = self.env['payment.acquirer'].sudo()._wompicol_get_acquirer(acquirer_id)
+        if not acquirer:
+            _logger.info('Wompicol: ignoring client return for unknown acquirer %s', acquirer_id)
+            return
+        Event = self.env['payment.wompicol.event'].sudo()
+        if Event.search_count([('event', '=', 'client_return'),
+                               ('wompi_id', '=', id),
+                               ('state', '=', 'pending')]):
+            return
+        event = Event._wompicol_enqueue_lookup(id, environment, acquirer if acquirer_id else None)
+        if getattr(threading.currentThread(), 'testing', False):
+            return event._wompicol_process()
+        event._wompicol_process_after_commit()
+
+    def _wompicol_get_data_manually(self, id, environment, acquirer_id=None):
         """When the client has returned and the payment transaction hasn't been
-        updated, check manually and update the transaction"""
+        updated, check manually and update the transaction, of the
+        acquirer with the id if given"""
+        Dedup = self.env['payment.wompicol.dedup'].sudo()
+        acquirer = self.env['payment.acquirer'].sudo()._wompicol_get_acquirer(acquirer_id)
+        if not acquirer:
+            _logger.warning("Wompicol: no wompicol acquirer %s to get data manually for id: %s", acquirer_id or '', id)
+            return
         # Check first if this transaciont has been updated already
         if id:
+            if Dedup._wompicol_is_final(id):
+                _logger.info("Wompicol: Not getting data manually, transaction already final.")
+                return
             tx = self.env[
                     'payment.transaction'
-                    ].search([('acquirer_reference', '=', id)])
+                    ].search([('acquirer_reference', '=', id),
+                              ('wompicol_reference', '!=', False)])
             if len(tx):
                 _logger.info("Wompicol: Not getting data manually, transaction already updated.")
                 return
 
-        api_url = self.acquirer_id._get_wompicol_api_url(environment)
-        request_url = f"{api_url}/transactions/{id}"
-        wompi_data = requests.get(request_url, timeout=60)
+        try:
+            wompi_data = {'data': acquirer._wompicol_get_transaction(
+                    id, environment)}
+        except requests.exceptions.RequestException as e:
+            # The queue retries the lookup
+            if self.env.context.get('wompicol_queue'):
+                raise
+            _logger.warning("Wompicol: unable to query wompi api for id: %s, %s", id, e)
+            return
         # If request succesful
-        if wompi_data.status_code == 200:
-            wompi_data = wompi_data.json()
-            _logger.info("Wompicol: Sucesfully called api for id: %s it returned data: %s"
-                         % (id, pprint.pformat(wompi_data)))
-            # pprint.pformat(post))
+        if wompi_data['data']:
+            _logger.info("Wompicol: Sucesfully called api for id: %s it returned data: %s",
+                         id, wompicol_logging.payload(wompi_data, wompicol_logging.sample_rate(self.env)))
+            wompicol_metrics.inc('wompicol_events_total', source='client_return',
+                                 status=wompi_data['data'].get('status'))
+            # The webhook could have been processed meanwhile
+            if not Dedup._wompicol_register(id, wompi_data['data'].get('status')):
+                _logger.info("Wompicol: Not updating manually, status already received.")
+                return
             # Data needed to validate is just on 'data'
             # Format it how it expects it
             wompi_data["data"] = {"transaction": wompi_data["data"]}
-            # Fix the reference code, only what's previous to _ is what we want
-            ref = wompi_data['data']['transaction']['reference']
-            if '_' in ref:
-                wompi_data['data']['transaction']['reference'] = ref.split('_')[0]
             # This avoid confirming the event, since the data is being
             # asked from the server. Instead of listening.
             wompi_data["noconfirm"] = True
             # If the transaction is a test.
             if environment == 'test':
                 wompi_data["test"] = True
-            _logger.info("Wompicol: creating transaction manually, by calling the api for acquirer reference %s" % id)
+            if acquirer_id:
+                wompi_data["acquirer_id"] = acquirer.id
+            _logger.info("Wompicol: creating transaction manually, by calling the api for acquirer reference %s", id)
             self.env['payment.transaction'].sudo().form_feedback(wompi_data, 'wompicol')
 
+    @wompicol_metrics.timed('confirm_event')
     def _wompicol_confirm_event(self, data):
-        """Wompi doesn't send anything to validate the event is
-        truthful, or that it comes from them, this method validates
-        by calling their api, and comparing values if values match
-        returns True, else throws an error"""
+        """Validate the event is truthful, and that it comes from wompi,
+        with the event signature, or calling their api if the acquirer
+        is configured that way or there's no events secret to use."""
+        environment = 'test' if data.get('test') else None
+        if self.acquirer_id.wompicol_event_verification != 'api':
+            secret = self.acquirer_id._get_wompicol_events_secret(environment)
+            if secret:
+                try:
+                    self._wompicol_confirm_event_signature(data, secret)
+                except ValidationError:
+                    wompicol_metrics.inc('wompicol_verifications_total', mode='signature', outcome='invalid')
+                    raise
+                wompicol_metrics.inc('wompicol_verifications_total', mode='signature', outcome='valid')
+                return True
+            _logger.warning('Wompicol: no events secret set, validating with wompi api.')
+        try:
+            valid = self._wompicol_confirm_event_api(data)
+        except ValidationError:
+            wompicol_metrics.inc('wompicol_verifications_total', mode='api', outcome='invalid')
+            raise
+        except wompicol_client.CircuitOpenError:
+            wompicol_metrics.inc('wompicol_verifications_total', mode='api', outcome='deferred')
+            raise
+        wompicol_metrics.inc('wompicol_verifications_total', mode='api',
+                             outcome='valid' if valid else 'unavailable')
+        return valid
+
+    @api.model
+    def _wompicol_event_checksum(self, data, secret):
+        """The checksum of the event as wompi computes it: sha256 of
+        the values of the signature properties, in order, followed by
+        the timestamp and the events secret."""
+        # Example of the signature of an event
+        # "signature": {
+        #   "properties": [
+        #     "transaction.id",
+        #     "transaction.status",
+        #     "transaction.amount_in_cents"
+        #   ],
+        #   "checksum": "3476DDA50F64CD7CBD160689640506FEBEA93239BC524FC0469B2C68A3CC8BD0"
+        # },
+        # "timestamp": 1530291411
+        properties = data.get('signature', {}).get('properties', [])
+        values = []
+        for prop in properties:
+            value = data.get('data', {})
+            for name in prop.split('.'):
+                value = value.get(name) if isinstance(value, dict) else None
+            values.append('' if value is None else str(value))
+        values.append(str(data.get('timestamp', '')))
+        values.append(secret)
+        return sha256(''.join(values).encode('utf-8')).hexdigest()
+
+    def _wompicol_confirm_event_signature(self, data, secret):
+        """Validate the event checksum with the events secret, returns
+        True, else throws an error."""
+        checksum = data.get('signature', {}).get('checksum') or ''
+        expected = self._wompicol_event_checksum(data, secret)
+        if not hmac.compare_digest(checksum.upper(), expected.upper()):
+            error_msg = (_('WompiCol: invalid signature for event of transaction %s') % (data.get('data').get('transaction').get('id')))
+            raise ValidationError(error_msg)
+        self._wompicol_check_timestamp(data)
+        _logger.info('Wompicol: event signature sucessfully validated')
+        return True
+
+    @api.model
+    def _wompicol_check_timestamp(self, data):
+        """The signed timestamp of the event must be within the
+        payment_wompicol.event_max_age seconds before it was received,
+        received_at is set by the event url, else it's now, so a signed
+        event captured can't be delivered again later."""
+        max_age = int(self.env['ir.config_parameter'].sudo().get_param(
+                'payment_wompicol.event_max_age', 172800))
+        received_at = data.get('received_at') or time.time()
+        try:
+            timestamp = int(data.get('timestamp'))
+        except (TypeError, ValueError):
+            timestamp = None
+        # A few minutes of clock skew are tolerated
+        if timestamp is None or not (received_at - max_age <= timestamp <= received_at + 300):
+            raise ValidationError(
+                _('WompiCol: event of transaction %s with timestamp %s out of the accepted window')
+                % (data.get('data', {}).get('transaction', {}).get('id'), data.get('timestamp')))
+        return True
+
+    def _wompicol_confirm_event_api(self, data):
+        """Validate the event by calling their api, and comparing values
+        if values match returns True, else throws an error"""
 
         # This is the response from wompi when asking about a transaction
         # {
@@ -229,20 +662,20 @@ class PaymentTransactionWompiCol(models.Model):
         to_check = ['id', 'reference', 'currency', 'status', 'amount_in_cents']
         # Data posted to the server
         tx_data = data.get('data').get('transaction')
-        # Get the api url
-        api_url = self.acquirer_id._get_wompicol_api_url(data.get('test'))
-        # Format the url
-        request_url = f"{api_url}/transactions/{tx_data.get('id')}"
-        # ask for the data
-        wompi_data = requests.get(request_url, timeout=60)
+        environment = 'test' if data.get('test') else None
         _logger.info('Wompicol: calling wompi api to validate the data.')
+        # ask for the data
+        try:
+            wompi_data = self.acquirer_id._wompicol_get_transaction(
+                    tx_data.get('id'), environment, tx_data.get('status'))
+        except wompicol_client.CircuitOpenError:
+            # Let the caller defer the event until the api is back
+            raise
+        except requests.exceptions.RequestException as e:
+            _logger.warning('Wompicol: unable to query wompi api for transaction ref: %s, %s', self.reference, e)
+            return False
         # If request succesful
-        if wompi_data.status_code == 200:
-            # Data needed to validate is just on 'data'
-            wompi_data = wompi_data.json().get('data')
-            # Fix the reference code, only what's previous to _ is what we want
-            if '_' in wompi_data['reference']:
-                wompi_data['reference'] = wompi_data['reference'].split('_')[0]
+        if wompi_data:
             # Basically compare between event received and what wompi api says
             # if a value doesnt match add tuple (name, value)
             invalid = [(val, tx_data.get(val)) for val in to_check
@@ -255,10 +688,27 @@ class PaymentTransactionWompiCol(models.Model):
                 _logger.info('Wompicol: data received sucessfully validated with wompi api')
                 return True
         else:
-            _logger.warn('Wompicol: unable to query wompi api for transaction ref: %s, response code %s' % (self.reference, wompi_data.status_code))
+            _logger.warning('Wompicol: wompi api returned no data for transaction ref: %s', self.reference)
             return False
 
     @api.model
+    def _wompicol_search_reference(self, reference, acquirer_id=None):
+        """Find the transaction of the wompi reference, the one generated
+        in wompicol_form_generate_values. Transactions paid with a
+        reference generated before the last one, or before the reference
+        was stored, are matched by the odoo reference, that is what goes
+        before the last '_'. If the acquirer is given, only among its
+        transactions, an event of a merchant can't touch the others."""
+        domain = [('acquirer_id', '=', acquirer_id)] if acquirer_id else []
+        transaction = self.search(domain + [('wompicol_reference', '=', reference)])
+        if not transaction:
+            transaction = self.search(domain + [('reference', '=', reference)])
+        if not transaction and '_' in reference:
+            transaction = self.search(domain + [('reference', '=', reference.rsplit('_', 1)[0])])
+        return transaction
+
+    @api.model
+    @wompicol_metrics.timed('get_tx_from_data')
     def _wompicol_form_get_tx_from_data(self, data):
         """ Given a data dict coming from wompicol, verify it
         and find the related transaction record. """
@@ -291,19 +741,20 @@ class PaymentTransactionWompiCol(models.Model):
         if not reference or not txnid:
             raise ValidationError(_('WompiCol: received data with missing reference: (%s) or transaction id: (%s)') % (reference, txnid))
 
-        transaction = self.search([('reference', '=', reference)])
+        transaction = self._wompicol_search_reference(reference, data.get('acquirer_id'))
 
         if not transaction:
             error_msg = (_('WompiCol: received data for reference: %s; no order found') % (reference))
-            raise ValidationError(error_msg)
+            raise TransactionNotFoundError(error_msg)
         elif len(transaction) > 1:
             error_msg = (_('WompiCol: received data for reference: %s; multiple orders found') % (reference))
             raise ValidationError(error_msg)
         else:
-            _logger.info('WompiCol: received reference: %s transaction id found: %s' % (reference, transaction.id))
+            _logger.info('WompiCol: received reference: %s transaction id found: %s', reference, transaction.id)
 
         return transaction
 
+    @wompicol_metrics.timed('get_invalid_parameters')
     def _wompicol_form_get_invalid_parameters(self, data):
         """ Given a data dict coming from wompicol, verify it and
         return any invalid parameters, to stop the processing of the
@@ -328,11 +779,14 @@ class PaymentTransactionWompiCol(models.Model):
                                        self.acquirer_reference))
 
         if not invalid_parameters:
-            _logger.info('Wompicol: tx %s: has no invalid parameters'
-                         % (self.reference))
+            _logger.info('Wompicol: tx %s: has no invalid parameters', self.reference)
+        else:
+            _logger.warning('Wompicol: tx %s: invalid parameters %s for data %s',
+                            self.reference, invalid_parameters, wompicol_logging.dump(data))
 
         return invalid_parameters
 
+    @wompicol_metrics.timed('validate')
     def _wompicol_form_validate(self, data):
         """ Given a data dict coming from wompicol, that has an
         existing payment transaction associated with it, and has
@@ -346,38 +800,79 @@ class PaymentTransactionWompiCol(models.Model):
         tx_data = data.get('data').get('transaction')
         status = tx_data.get('status')
 
+        # The webhook and the client return usually arrive at the same
+        # time, only one of them updates the transaction.
+        if not self._wompicol_lock():
+            if self.env.context.get('wompicol_queue'):
+                raise TransactionLockedError(
+                    f"Wompicol: tx {self.reference} locked by another worker")
+            _logger.info('Wompicol: tx %s locked by another worker, deferring the event', self.reference)
+            self.env['payment.wompicol.event'].sudo()._wompicol_enqueue(
+                    data, self.acquirer_id, error='locked by another worker')
+            return False
+        if status == 'APPROVED' and self.state == 'done' and self.is_processed:
+            _logger.info('Wompicol: tx %s already done and processed', self.reference)
+            return True
+        stale = self._wompicol_stale_event(data)
+        if stale:
+            _logger.info('Wompicol: skipping event of tx %s, %s', self.reference, stale)
+            return True
+
         # Check if the data received matches what's in wompi servers
         # Do not do it if running and odoo test, or if the data was
         # queried, not received.
         if not data.get('noconfirm', False):
-            self._wompicol_confirm_event(data)
+            if not self._wompicol_confirm_event(data):
+                raise EventNotVerifiedError(
+                    _('WompiCol: unable to verify the event for tx %s with wompi api') % (self.reference))
 
         res = {
             'acquirer_reference': tx_data.get('id'),  # Wompi internal id
+            'wompicol_reference': tx_data.get('reference'),
             'state_message': f"Wompicol states the transactions as {status}"
         }
 
+        if data.get('sent_at'):
+            res['wompicol_event_date'] = data['sent_at']
+
         # If came from the test endpoint
         if data.get('test'):
             res["state_message"] = 'TEST TRANSACTION: ' + res["state_message"]
 
+        # Paid with a payment source, keep it if the customer asked
+        if self.type == 'form_save' and tx_data.get('payment_source_id') \
+           and not self.payment_token_id:
+            res['payment_token_id'] = self.acquirer_id.wompicol_s2s_form_process({
+                'payment_source_id': tx_data['payment_source_id'],
+                'partner_id': self.partner_id.id,
+            }).id
+
         if status == 'APPROVED':
-            _logger.info('Validated WompiCol payment for tx %s: setting as done' % (self.reference))
+            _logger.info('Validated WompiCol payment for tx %s: setting as done', self.reference)
             res.update(state='done', date=fields.Datetime.now())
-            self._set_transaction_done()
+            with wompicol_metrics.span('set_transaction_done'):
+                self._set_transaction_done()
             # Takes care of setting the order as paid right away
             self.write(res)
-            self.execute_callback()
+            with wompicol_metrics.span('execute_callback'):
+                self.execute_callback()
             if not self.is_processed:
-                self._post_process_after_done()
+                with wompicol_metrics.span('post_process_after_done'):
+                    self._post_process_after_done()
             return True
         elif status == 'PENDING':
-            _logger.info('Received notification for WompiCol payment %s: setting as pending' % (self.reference))
+            _logger.info('Received notification for WompiCol payment %s: setting as pending', self.reference)
             res.update(state='pending')
             self._set_transaction_pending()
             return self.write(res)
+        elif status == 'VOIDED' and self.state == 'done':
+            # Its payment is reversed in odoo, the state is kept
+            _logger.info('Received void of WompiCol payment %s: keeping it done', self.reference)
+            res.update(wompicol_voided=True,
+                       state_message=self._wompicol_target_state(status, data, self.state)[1])
+            return self.write(res)
         elif status in ['VOIDED', 'DECLINED', 'ERROR']:
-            _logger.info('Received notification for WompiCol payment %s: setting as Cancel' % (self.reference))
+            _logger.info('Received notification for WompiCol payment %s: setting as Cancel', self.reference)
             res.update(state='cancel')
             self._set_transaction_cancel()
             return self.write(res)
@@ -387,3 +882,533 @@ class PaymentTransactionWompiCol(models.Model):
             res.update(state='cancel', state_message=error)
             self._set_transaction_cancel()
             return self.write(res)
+
+    def _wompicol_stale_event(self, data):
+        """Why the event must not be applied to the transaction, False if
+        it can be. Events are delivered late, retried and deferred, one
+        must never take a final state back to pending, nor undo a newer
+        event."""
+        self.ensure_one()
+        status = data['data']['transaction'].get('status')
+        if self.state in ('done', 'cancel') \
+           and self._wompicol_target_state(status, data, self.state)[0] not in ('done', 'cancel', 'voided'):
+            return f"already {self.state}, ignoring {status}"
+        sent_at = data.get('sent_at')
+        if sent_at and self.wompicol_event_date and str(sent_at) < self.wompicol_event_date:
+            return f"sent at {sent_at}, before the last event applied at {self.wompicol_event_date}"
+        return False
+
+    @api.model
+    def _wompicol_batch_params(self):
+        ICP = self.env['ir.config_parameter'].sudo()
+        chunk_size = int(ICP.get_param('payment_wompicol.batch_chunk_size', 500))
+        return max(chunk_size, 1)
+
+    @api.model
+    def _wompicol_http_map(self, name, func, jobs):
+        """Run func on every job with a pool of threads, as many as the
+        payment_wompicol.<name>_workers parameter, returns the results
+        in order. The threads only do http, they must not use the
+        environment, the jobs carry whatever they need."""
+        if not jobs:
+            return []
+        workers = int(self.env['ir.config_parameter'].sudo().get_param(
+                'payment_wompicol.%s_workers' % name, 8))
+        with ThreadPoolExecutor(max_workers=min(max(workers, 1), len(jobs))) as executor:
+            return list(executor.map(func, jobs))
+
+    @api.model
+    def _wompicol_form_feedback_batch(self, events):
+        """Process a list of wompi events at once, as form_feedback does
+        for each one, with a search, a verification pass and a write per
+        target state for each chunk of events. Only the last event of
+        every wompi transaction is applied. Returns the count of events
+        by outcome."""
+        chunk_size = self._wompicol_batch_params()
+        result = dict.fromkeys(('done', 'pending', 'cancel', 'voided', 'unchanged', 'duplicate',
+                                'superseded', 'deferred', 'failed'), 0)
+        latest = {}
+        # Events are sorted by sent_at, the order of the list is kept
+        # for the ones sent at the same time.
+        for data in sorted(events, key=lambda data: str(data.get('sent_at') or '')
+                           if isinstance(data, dict) else ''):
+            tx_data = isinstance(data, dict) and (data.get('data') or {}).get('transaction') or {}
+            if not isinstance(tx_data, dict) or not tx_data.get('id') or not tx_data.get('reference'):
+                _logger.warning('Wompicol: batch event with missing data %s', wompicol_logging.dump(data))
+                result['failed'] += 1
+                continue
+            if tx_data['id'] in latest:
+                result['superseded'] += 1
+            latest[tx_data['id']] = data
+        events = list(latest.values())
+        _logger.info('Wompicol: processing a batch of %s events', len(events))
+        for start in range(0, len(events), chunk_size):
+            with wompicol_metrics.span('feedback_batch'):
+                self._wompicol_feedback_chunk(events[start:start + chunk_size], result)
+        return result
+
+    @api.model
+    def _wompicol_prefetch_transactions(self, jobs):
+        """Fetch the wompi transactions of the jobs (client, wompi id,
+        status) into the shared cache, with a pool of threads that only
+        do http, the verification then reads them from the cache."""
+        def fetch(job):
+            client, wompi_id, status = job
+            try:
+                client.get_transaction(wompi_id, status)
+            except requests.exceptions.RequestException as e:
+                _logger.info('Wompicol: unable to prefetch transaction %s: %s', wompi_id, e)
+
+        self._wompicol_http_map('batch', fetch, jobs)
+
+    @api.model
+    def _wompicol_feedback_chunk(self, events, result):
+        Dedup = self.env['payment.wompicol.dedup'].sudo()
+        Event = self.env['payment.wompicol.event'].sudo()
+
+        fresh = []
+        for data in events:
+            wompicol_metrics.inc('wompicol_events_total', source='batch',
+                                 status=data['data']['transaction'].get('status'))
+            if Dedup._wompicol_register_event(data):
+                fresh.append(data)
+            else:
+                result['duplicate'] += 1
+        if not fresh:
+            return
+
+        # A single search for all the references, matched in the same
+        # order as _wompicol_search_reference does.
+        references = {data['data']['transaction']['reference'] for data in fresh}
+        candidates = references | {reference.rsplit('_', 1)[0]
+                                   for reference in references if '_' in reference}
+        txs = self.search(['|',
+                           ('wompicol_reference', 'in', list(references)),
+                           ('reference', 'in', list(candidates))])
+        by_wompi_reference = {tx.wompicol_reference: tx for tx in txs if tx.wompicol_reference}
+        by_reference = {tx.reference: tx for tx in txs}
+
+        matched = {}
+        for data in fresh:
+            reference = data['data']['transaction']['reference']
+            tx = by_wompi_reference.get(reference) or by_reference.get(reference)
+            if not tx and '_' in reference:
+                tx = by_reference.get(reference.rsplit('_', 1)[0])
+            if tx and data.get('acquirer_id') and tx.acquirer_id.id != data['acquirer_id']:
+                tx = None
+            if not tx:
+                _logger.info('Wompicol: batch event for reference %s, no order found', reference)
+                Event._wompicol_enqueue(data)._wompicol_failed(
+                        _('WompiCol: received data for reference: %s; no order found') % reference)
+                result['deferred'] += 1
+                continue
+            if tx.id in matched:
+                result['superseded'] += 1
+            matched[tx.id] = data
+
+        locked = self.browse(list(matched))._wompicol_lock()
+        for tx_id in set(matched) - set(locked.ids):
+            Event._wompicol_enqueue(matched.pop(tx_id), self.browse(tx_id).acquirer_id,
+                                    error='locked by another worker')
+            result['deferred'] += 1
+
+        # Verify with the api concurrently, warming up the cache
+        jobs = []
+        for tx in locked:
+            data = matched[tx.id]
+            environment = 'test' if data.get('test') else None
+            if not data.get('noconfirm') and (
+                    tx.acquirer_id.wompicol_event_verification == 'api'
+                    or not tx.acquirer_id._get_wompicol_events_secret(environment)):
+                tx_data = data['data']['transaction']
+                jobs.append((tx.acquirer_id._get_wompicol_client(environment),
+                             tx_data['id'], tx_data.get('status')))
+        self._wompicol_prefetch_transactions(jobs)
+
+        groups = {}
+        for tx in locked:
+            data = matched[tx.id]
+            tx_data = data['data']['transaction']
+            status = tx_data.get('status')
+            if status == 'APPROVED' and tx.state == 'done' and tx.is_processed:
+                result['unchanged'] += 1
+                continue
+            stale = tx._wompicol_stale_event(data)
+            if stale:
+                _logger.info('Wompicol: skipping batch event of tx %s, %s', tx.reference, stale)
+                result['unchanged'] += 1
+                continue
+            try:
+                if tx._wompicol_form_get_invalid_parameters(data):
+                    Dedup._wompicol_forget_event(data)
+                    result['failed'] += 1
+                    continue
+                if not data.get('noconfirm') and not tx._wompicol_confirm_event(data):
+                    Event._wompicol_enqueue(data, tx.acquirer_id)._wompicol_failed(
+                            _('WompiCol: unable to verify the event for tx %s with wompi api') % tx.reference)
+                    result['deferred'] += 1
+                    continue
+            except wompicol_client.CircuitOpenError as e:
+                Event._wompicol_enqueue(data, tx.acquirer_id, error=str(e))
+                result['deferred'] += 1
+                continue
+            except ValidationError as e:
+                _logger.warning('Wompicol: batch event of tx %s rejected: %s', tx.reference, e)
+                Dedup._wompicol_forget_event(data)
+                result['failed'] += 1
+                continue
+
+            values = {
+                'acquirer_reference': tx_data['id'],
+                'wompicol_reference': tx_data['reference'],
+            }
+            if data.get('sent_at'):
+                values['wompicol_event_date'] = data['sent_at']
+            if any(tx[field] != value for field, value in values.items()):
+                tx.write(values)
+            state, message = self._wompicol_target_state(status, data, tx.state)
+            groups.setdefault((state, message), []).append(tx.id)
+
+        # A write per target state
+        now = fields.Datetime.now()
+        for (state, message), tx_ids in groups.items():
+            txs = self.browse(tx_ids)
+            try:
+                with self.env.cr.savepoint():
+                    if state == 'done':
+                        txs._set_transaction_done()
+                        txs.write({'state': state, 'state_message': message, 'date': now})
+                        txs.execute_callback()
+                        txs.filtered(lambda tx: not tx.is_processed)._post_process_after_done()
+                    elif state == 'pending':
+                        txs._set_transaction_pending()
+                        txs.write({'state': state, 'state_message': message})
+                    elif state == 'voided':
+                        txs.write({'wompicol_voided': True, 'state_message': message})
+                    else:
+                        txs._set_transaction_cancel()
+                        txs.write({'state': state, 'state_message': message})
+            except Exception as e:
+                _logger.warning('Wompicol: batch of %s transactions to %s failed, deferring: %s',
+                                len(txs), state, e)
+                for tx in txs:
+                    Event._wompicol_enqueue(matched[tx.id], tx.acquirer_id)._wompicol_failed(str(e))
+                result['deferred'] += len(txs)
+                continue
+            _logger.info('Wompicol: batch set %s transactions as %s', len(txs), state)
+            result[state] += len(txs)
+
+    @api.model
+    def _wompicol_target_state(self, status, data, state=None):
+        """The state and state message of a transaction in the given
+        state for the wompi status, as _wompicol_form_validate sets
+        them, 'voided' when a done one is voided, it stays done."""
+        message = f"Wompicol states the transactions as {status}"
+        if data.get('test'):
+            message = 'TEST TRANSACTION: ' + message
+        if status == 'VOIDED' and state == 'done':
+            return 'voided', 'Voided in wompi, reverse its payment'
+        if status == 'APPROVED':
+            return 'done', message
+        if status == 'PENDING':
+            return 'pending', message
+        if status in ('VOIDED', 'DECLINED', 'ERROR'):
+            return 'cancel', message
+        return 'cancel', 'Received unrecognized status for WompiCol payment: %s, setting as error' % status
+
+    def wompicol_void(self, amount=None):
+        """Void the approved wompi transactions, all of each one, or
+        only the amount given of a single one. The calls are made by a
+        pool of threads that only do http, limited per merchant, the
+        results are written with a write per outcome. The void is only
+        recorded, the transactions stay done, their payments have to be
+        reversed in odoo. Returns {tx id: {'ok': bool, 'status', 'error'}}."""
+        if amount and len(self) > 1:
+            raise ValidationError(_('WompiCol: an amount can only be voided of a single transaction.'))
+        results = {}
+        jobs = []
+        for tx in self:
+            if tx.acquirer_id.provider != 'wompicol' or tx.state != 'done' \
+               or not tx.acquirer_reference or tx.wompicol_voided:
+                results[tx.id] = {'ok': False, 'status': None,
+                                  'error': _('WompiCol: only approved wompi transactions can be voided')}
+                continue
+            acquirer = tx.acquirer_id
+            jobs.append((tx.id, acquirer._get_wompicol_client(), acquirer._get_keys()[0],
+                         acquirer._get_wompicol_rate_limiter(), tx.acquirer_reference,
+                         math.ceil(amount) * 100 if amount else None))
+
+        def void(job):
+            tx_id, client, private_key, limiter, wompi_id, amount_in_cents = job
+            limiter.acquire()
+            start = time.monotonic()
+            try:
+                data = client.void_transaction(private_key, wompi_id, amount_in_cents)
+            except requests.exceptions.RequestException as e:
+                _logger.warning('Wompicol: void of transaction %s failed: %s', wompi_id, e)
+                return tx_id, {'ok': False, 'status': None, 'error': str(e)}
+            finally:
+                wompicol_metrics.observe('wompicol_stage_seconds', time.monotonic() - start, stage='void')
+            status = data.get('status') or (data.get('transaction') or {}).get('status')
+            return tx_id, {'ok': True, 'status': status, 'error': None}
+
+        results.update(self._wompicol_http_map('void', void, jobs))
+
+        # A write per outcome
+        submitted = {job[0] for job in jobs}
+        groups = {}
+        for tx_id, result in results.items():
+            if result['ok'] and not amount and result['status'] in ('APPROVED', 'VOIDED'):
+                values = (('wompicol_voided', True),
+                          ('state_message', 'Voided in wompi, reverse its payment'))
+            elif result['ok']:
+                values = (('state_message', 'Void of %s requested in wompi, %s' % (
+                              amount or 'the transaction', result['status'])),)
+            elif tx_id in submitted:
+                values = (('state_message', 'Void in wompi failed: %s' % result['error']),)
+            else:
+                continue
+            groups.setdefault(values, []).append(tx_id)
+        for values, tx_ids in groups.items():
+            self.browse(tx_ids).write(dict(values))
+        _logger.info('Wompicol: voided %s of %s transactions',
+                     sum(1 for result in results.values() if result['ok']), len(self))
+        return results
+
+    @api.model
+    def _wompicol_charge_params(self):
+        ICP = self.env['ir.config_parameter'].sudo()
+        # Seconds between the checks of a pending charge, and how many
+        poll_interval = float(ICP.get_param('payment_wompicol.charge_poll_interval', 2))
+        poll_attempts = int(ICP.get_param('payment_wompicol.charge_poll_attempts', 10))
+        return poll_interval, poll_attempts
+
+    def wompicol_s2s_do_transaction(self, **kwargs):
+        self.ensure_one()
+        result = self.wompicol_charge_tokens().get(self.id, {})
+        return result.get('ok', False) and result.get('status') in ('APPROVED', 'PENDING')
+
+    def wompicol_charge_tokens(self):
+        """Charge the draft transactions to their payment tokens. The
+        charges are created by a pool of threads that only do http,
+        limited per merchant, each one polled until it leaves pending
+        or the attempts run out, the statuses are then applied as a
+        batch of events. Only a 4xx answer sets a transaction as error,
+        the others may have been charged, they are left pending like
+        the charges still pending, to be finished by the events or the
+        reconciliation, which finds them by their wompi reference.
+        Transactions already sent to wompi are never charged again.
+        Returns {tx id: {'ok', 'status', 'error'}}."""
+        poll_interval, poll_attempts = self._wompicol_charge_params()
+        results = {}
+        jobs = []
+        for tx in self:
+            if tx.acquirer_id.provider != 'wompicol' or tx.state != 'draft' \
+               or not tx.payment_token_id or tx.currency_id.name != 'COP':
+                results[tx.id] = {'ok': False, 'status': None,
+                                  'error': _('WompiCol: only draft COP transactions with a payment token can be charged')}
+                continue
+            if tx.wompicol_reference:
+                results[tx.id] = {'ok': False, 'status': None,
+                                  'error': _('WompiCol: transaction already sent to wompi')}
+                continue
+            acquirer = tx.acquirer_id
+            source_id = tx.payment_token_id.acquirer_ref
+            jobs.append((tx.id, acquirer.id, acquirer._wompicol_config()['environment'],
+                         acquirer._get_wompicol_client(), acquirer._get_keys()[0],
+                         acquirer._get_wompicol_rate_limiter(), {
+                'acceptance_token': acquirer._wompicol_get_acceptance()['acceptance_token'],
+                # Wompi wants cents (*100) and has to end on 00.
+                'amount_in_cents': math.ceil(tx.amount) * 100,
+                'currency': 'COP',
+                'customer_email': tx.partner_email,
+                'reference': acquirer._wompicol_new_reference(tx.reference),
+                'payment_source_id': int(source_id) if source_id.isdigit() else source_id,
+                'payment_method': {'installments': 1},
+                'recurrent': True,
+            }))
+
+        def charge(job):
+            tx_id, acquirer_id, environment, client, private_key, limiter, values = job
+            start = time.monotonic()
+            try:
+                limiter.acquire()
+                data = client.create_transaction(private_key, values)
+            except requests.exceptions.RequestException as e:
+                _logger.warning('Wompicol: charge of %s failed: %s', values['reference'], e)
+                wompicol_metrics.observe('wompicol_charge_seconds', time.monotonic() - start, outcome='error')
+                # Only a 4xx answer says for sure nothing was charged
+                response = getattr(e, 'response', None)
+                rejected = response is not None and 400 <= response.status_code < 500
+                return tx_id, acquirer_id, environment, None, (str(e), rejected)
+            for i in range(poll_attempts):
+                if (data or {}).get('status') != 'PENDING':
+                    break
+                time.sleep(poll_interval)
+                limiter.acquire()
+                try:
+                    data = client.get_transaction(data['id'], fresh=True)
+                except requests.exceptions.RequestException as e:
+                    _logger.info('Wompicol: unable to poll charge %s: %s', data['id'], e)
+                    break
+            wompicol_metrics.observe('wompicol_charge_seconds', time.monotonic() - start,
+                                     outcome=(data or {}).get('status'))
+            return tx_id, acquirer_id, environment, data, None
+
+        events = []
+        charged = []
+        failed = {}
+        unknown = {}
+        for tx_id, acquirer_id, environment, data, error in self._wompicol_http_map('charge', charge, jobs):
+            if data:
+                results[tx_id] = {'ok': True, 'status': data.get('status'), 'error': None}
+                charged.append(tx_id)
+                events.append({
+                    'event': 'transaction.updated',
+                    'data': {'transaction': dict(data)},
+                    'noconfirm': True,
+                    'test': environment == 'test',
+                    'acquirer_id': acquirer_id,
+                })
+            else:
+                error, rejected = error
+                results[tx_id] = {'ok': False, 'status': None, 'error': error}
+                (failed if rejected else unknown).setdefault(error, []).append(tx_id)
+
+        # A write per error, the charged ones pending until their status
+        # is applied as a batch of events, deferred ones stay pending.
+        for error, tx_ids in failed.items():
+            self.browse(tx_ids)._set_transaction_error('Charge in wompi failed: %s' % error)
+        self.browse(charged + [tx_id for tx_ids in unknown.values() for tx_id in tx_ids]
+                    )._set_transaction_pending()
+        for error, tx_ids in unknown.items():
+            self.browse(tx_ids).write({
+                'state_message': 'Charge in wompi unknown, left to the reconciliation: %s' % error})
+        if events:
+            self._wompicol_form_feedback_batch(events)
+        _logger.info('Wompicol: charged %s of %s transactions, %s failed',
+                     len(events), len(self), len(self) - len(events))
+        return results
+
+    @api.model
+    def _wompicol_reconcile_params(self):
+        ICP = self.env['ir.config_parameter'].sudo()
+        page_size = int(ICP.get_param('payment_wompicol.reconcile_page_size', 100))
+        # Minutes to wait before checking a transaction again, doubled
+        # on every check, up to a day.
+        backoff = int(ICP.get_param('payment_wompicol.reconcile_backoff', 5))
+        # Checks before giving up on a transaction, about two weeks
+        max_checks = int(ICP.get_param('payment_wompicol.reconcile_max_checks', 20))
+        # Hours a draft with a wompi reference is looked for, the
+        # reference is set when the form is rendered, most of those
+        # carts never reach wompi.
+        draft_max_age = int(ICP.get_param('payment_wompicol.reconcile_draft_max_age', 24))
+        return page_size, backoff, max_checks, draft_max_age
+
+    @api.model
+    def _wompicol_reconcile_domain(self, last_id=0, max_checks=None, draft_max_age=None):
+        params = self._wompicol_reconcile_params()
+        if max_checks is None:
+            max_checks = params[2]
+        if draft_max_age is None:
+            draft_max_age = params[3]
+        draft_since = fields.Datetime.now() - datetime.timedelta(hours=draft_max_age)
+        return [
+            ('acquirer_id.provider', '=', 'wompicol'),
+            ('state', 'in', ('draft', 'pending')),
+            # Known by wompi, or rendered with a wompi reference recently
+            '|',
+            ('acquirer_reference', '!=', False),
+            '&',
+            ('wompicol_reference', '!=', False),
+            '|',
+            ('state', '=', 'pending'),
+            ('create_date', '>=', draft_since),
+            ('id', '>', last_id),
+            ('wompicol_check_count', '<', max_checks),
+            '|',
+            ('wompicol_next_check', '=', False),
+            ('wompicol_next_check', '<=', fields.Datetime.now()),
+        ]
+
+    def _wompicol_fetch_statuses(self):
+        """Ask wompi for the transactions, using a pool of threads, the
+        threads only do http, returns {tx id: wompi data or None}."""
+        jobs = [(tx.id, tx.acquirer_id._get_wompicol_client(),
+                 tx.acquirer_reference, tx.wompicol_reference,
+                 tx.acquirer_id._get_keys()[0])
+                for tx in self]
+
+        def fetch(job):
+            tx_id, client, wompi_id, reference, private_key = job
+            try:
+                if wompi_id:
+                    return tx_id, client.get_transaction(wompi_id)
+                # Never came back from wompi, look for it by reference
+                return tx_id, client.find_transaction(reference, private_key)
+            except requests.exceptions.RequestException as e:
+                _logger.info('Wompicol: unable to reconcile transaction %s: %s', wompi_id or reference, e)
+                return tx_id, None
+
+        return dict(self._wompicol_http_map('reconcile', fetch, jobs))
+
+    def _wompicol_reconcile(self, backoff=5, max_checks=20):
+        """Update the transactions with the status reported by wompi, the
+        ones still pending are scheduled to be checked again later, until
+        they run out of checks."""
+        if not self:
+            return
+        statuses = self._wompicol_fetch_statuses()
+        unchanged = self.browse()
+        for tx in self:
+            wompi_data = statuses.get(tx.id)
+            if not wompi_data or wompi_data.get('status') == 'PENDING':
+                unchanged |= tx
+                continue
+            data = {
+                'data': {'transaction': wompi_data},
+                'noconfirm': True,
+                'test': tx.acquirer_id.state != 'enabled',
+            }
+            try:
+                with self.env.cr.savepoint():
+                    if not tx._wompicol_form_get_invalid_parameters(data):
+                        tx._wompicol_form_validate(data)
+                    else:
+                        unchanged |= tx
+            except Exception as e:
+                _logger.warning('Wompicol: reconciliation of %s failed: %s', tx.reference, e)
+                unchanged |= tx
+
+        # Schedule the next check, one write per backoff step
+        now = fields.Datetime.now()
+        for count, txs in itertools.groupby(unchanged.sorted('wompicol_check_count'),
+                                            key=lambda tx: tx.wompicol_check_count):
+            txs = self.browse([tx.id for tx in txs])
+            if count + 1 >= max_checks:
+                _logger.warning('Wompicol: giving up reconciling %s after %s checks',
+                                ', '.join(txs.mapped('reference')), count + 1)
+            delay = min(backoff * 2 ** count, 24 * 60)
+            txs.write({
+                'wompicol_check_count': count + 1,
+                'wompicol_next_check': now + datetime.timedelta(minutes=delay),
+            })
+
+    @api.model
+    def _cron_wompicol_reconcile_pending(self):
+        """Reconcile the wompicol transactions stuck in draft or pending,
+        in pages, commiting after each page."""
+        page_size, backoff, max_checks, draft_max_age = self._wompicol_reconcile_params()
+        testing = getattr(threading.currentThread(), 'testing', False)
+        last_id = 0
+        while True:
+            txs = self.search(self._wompicol_reconcile_domain(last_id, max_checks, draft_max_age),
+                              order='id', limit=page_size)
+            if not txs:
+                break
+            last_id = txs[-1].id
+            _logger.info('Wompicol: reconciling %s pending transactions', len(txs))
+            txs._wompicol_reconcile(backoff, max_checks)
+            if not testing:
+                self.env.cr.commit()
+            self.invalidate_cache()
@@ -0,0 +1,115 @@
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LRUCache(object):
+    """Thread safe mapping bounded to maxsize entries, when full the
+    least recently used entry is dropped."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value=True):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TTLCache(object):
+    """LRU cache whose entries expire after a ttl set per entry, and
+    where concurrent loads of the same missing key are collapsed in a
+    single call to the loader, the other callers wait for its result."""
+
+    def __init__(self, maxsize=1024):
+        self._entries = LRUCache(maxsize)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        """Return (found, value) for the key if not expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires, value = entry
+        if expires < time.monotonic():
+            self._entries.pop(key)
+            return False, None
+        return True, value
+
+    def get(self, key, default=None):
+        found, value = self._lookup(key)
+        return value if found else default
+
+    def set(self, key, value, ttl):
+        self._entries.set(key, (time.monotonic() + ttl, value))
+
+    def invalidate(self, key, predicate=None):
+        """Drop the key, if predicate is given only when it returns
+        True for the cached value."""
+        found, value = self._lookup(key)
+        if found and (predicate is None or predicate(value)):
+            self._entries.pop(key)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_or_load(self, key, loader, ttl):
+        """Return the cached value or the one returned by loader(),
+        ttl(value) gives the seconds the loaded value is kept, errors
+        of the loader are raised to every waiting caller and are not
+        cached."""
+        found, value = self._lookup(key)
+        if found:
+            return value
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            value = loader()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            self.set(key, value, ttl(value))
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
@@ -0,0 +1,417 @@
+import base64
+import json
+import logging
+import threading
+import time
+
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import wompicol_metrics
+from .wompicol_cache import TTLCache
+
+
+_logger = logging.getLogger(__name__)
+
+# Wompi api base url for each environment.
+API_URLS = {
+    'prod': 'https://production.wompi.co/v1',
+    'test': 'https://sandbox.wompi.co/v1',
+}
+
+# Timeouts are (connect, read), a dead host fails fast, a slow answer
+# still gets some room.
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 20
+
+# The read timeout adapts to the observed latency, p95 times the
+# factor, never below the minimum nor above READ_TIMEOUT.
+MIN_READ_TIMEOUT = 2
+READ_TIMEOUT_FACTOR = 3
+LATENCY_WINDOW = 200
+
+# The circuit opens after this many consecutive failures, a call slower
+# than SLOW_CALL seconds counts as a failure, once open calls fail right
+# away for COOLDOWN seconds, then a single probe call is let through.
+FAILURE_THRESHOLD = 5
+SLOW_CALL = 10
+COOLDOWN = 30
+
+# Connection pool size per environment, roughly the number of threads
+# of a worker that could be talking to wompi at the same time.
+POOL_SIZE = 10
+
+# Retries are only done for idempotent methods, on connection errors
+# and 5xx responses, sleeping backoff * (2 ** (retry - 1)) in between.
+RETRY_TOTAL = 2
+RETRY_BACKOFF = 0.3
+RETRY_STATUS = (500, 502, 503, 504)
+RETRY_METHODS = frozenset(['GET', 'HEAD'])
+
+# Transactions looked up from the api, by (environment, id), a final
+# status won't change anymore so it's kept longer.
+FINAL_STATUSES = ('APPROVED', 'DECLINED', 'VOIDED', 'ERROR')
+TRANSACTION_TTL = 10
+TRANSACTION_FINAL_TTL = 600
+transactions_cache = TTLCache(maxsize=4096)
+
+# Merchant acceptance tokens, by (environment, public key), refreshed
+# ACCEPTANCE_TOKEN_MARGIN seconds before they expire, the ones whose
+# expiration can't be read are kept ACCEPTANCE_TOKEN_TTL seconds.
+ACCEPTANCE_TOKEN_TTL = 600
+ACCEPTANCE_TOKEN_MARGIN = 120
+acceptance_cache = TTLCache(maxsize=64)
+
+
+def _transaction_ttl(data):
+    if (data or {}).get('status') in FINAL_STATUSES:
+        return TRANSACTION_FINAL_TTL
+    return TRANSACTION_TTL
+
+
+def _acceptance_ttl(acceptance):
+    """Seconds to keep the acceptance, up to the margin before the exp
+    of the token, it's a jwt."""
+    try:
+        payload = acceptance['acceptance_token'].split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return max(int(claims['exp']) - time.time() - ACCEPTANCE_TOKEN_MARGIN, 0)
+    except (KeyError, IndexError, TypeError, ValueError):
+        return ACCEPTANCE_TOKEN_TTL
+
+
+def _build_retry():
+    """The retry policy, urllib3 renamed method_whitelist to
+    allowed_methods, support both."""
+    params = dict(
+        total=RETRY_TOTAL,
+        connect=RETRY_TOTAL,
+        read=RETRY_TOTAL,
+        status=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUS,
+        raise_on_status=False,
+    )
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **params)
+    except TypeError:
+        return Retry(method_whitelist=RETRY_METHODS, **params)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Wompi api considered down, the call wasn't made."""
+
+
+class CircuitBreaker(object):
+    """Failure memory of the calls to the api of an environment,
+    closed: calls go through, open: calls fail right away until
+    the cooldown passes, half_open: one probe call goes through, it
+    closes the circuit if it succeeds, opens it again if it fails."""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call shouldn't be made."""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < COOLDOWN:
+                    raise CircuitOpenError(f"wompi {self.name} api circuit open")
+                self.state = 'half_open'
+            if self.probing:
+                raise CircuitOpenError(f"wompi {self.name} api circuit half open")
+            self.probing = True
+
+    def record_success(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            if self.state != 'closed':
+                _logger.info('Wompicol: %s api circuit closed', self.name)
+            self.state = 'closed'
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self, latency=None):
+        with self._lock:
+            if latency is not None:
+                self.latencies.append(latency)
+            self.failures += 1
+            self.probing = False
+            if self.state == 'half_open' or self.failures >= FAILURE_THRESHOLD:
+                if self.state != 'open':
+                    _logger.warning('Wompicol: %s api circuit open after %s failures',
+                                    self.name, self.failures)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def p95(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+
+    def read_timeout(self):
+        p95 = self.p95()
+        if p95 is None:
+            return READ_TIMEOUT
+        return min(max(p95 * READ_TIMEOUT_FACTOR, MIN_READ_TIMEOUT), READ_TIMEOUT)
+
+
+class RateLimiter(object):
+    """Token bucket, acquire() blocks until a call is allowed, rate
+    calls per second on average, bursts of up to burst calls."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class WompiColClient(object):
+    """Keep alive http session to the Wompi api of one environment,
+    every call to wompi should go through here."""
+
+    def __init__(self, environment, base_url=None):
+        self.environment = environment
+        self.base_url = base_url or API_URLS[environment]
+        self.session = self._build_session()
+        self.breaker = CircuitBreaker(environment)
+
+    def _build_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=POOL_SIZE,
+                              max_retries=_build_retry())
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Accept': 'application/json'})
+        return session
+
+    def url(self, path):
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def request(self, method, path, timeout=None, **kwargs):
+        """Perform the request, connection errors that survived the
+        retries are raised as requests.exceptions.RequestException,
+        CircuitOpenError if the api is considered down."""
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            wompicol_metrics.inc('wompicol_api_responses_total',
+                                 environment=self.environment, status='circuit_open')
+            raise
+        timeout = timeout or (CONNECT_TIMEOUT, self.breaker.read_timeout())
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, self.url(path),
+                                            timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            wompicol_metrics.inc('wompicol_api_responses_total',
+                                 environment=self.environment, status='error')
+            raise
+        latency = time.monotonic() - start
+        wompicol_metrics.inc('wompicol_api_responses_total',
+                             environment=self.environment, status=response.status_code)
+        wompicol_metrics.observe('wompicol_api_seconds', latency,
+                                 environment=self.environment)
+        if response.status_code >= 500 or latency > SLOW_CALL:
+            self.breaker.record_failure(latency)
+        else:
+            self.breaker.record_success(latency)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def _fetch_transaction(self, wompi_id):
+        response = self.get(f"/transactions/{wompi_id}")
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(
+                f"wompi api answered {response.status_code} for transaction {wompi_id}",
+                response=response)
+        return response.json().get('data')
+
+    def get_transaction(self, wompi_id, status=None, fresh=False):
+        """The data of the wompi transaction, shared by every caller
+        of the process. If the caller knows the transaction is in
+        a status different from the cached one, it's fetched again,
+        with fresh always, to poll it.
+        Raises requests.exceptions.RequestException on failure."""
+        key = (self.environment, wompi_id)
+        if fresh:
+            transactions_cache.invalidate(key)
+        elif status:
+            transactions_cache.invalidate(
+                key, lambda data: (data or {}).get('status') != status)
+        return transactions_cache.get_or_load(
+            key, lambda: self._fetch_transaction(wompi_id), _transaction_ttl)
+
+    def find_transaction(self, reference, private_key):
+        """The last transaction created in wompi with the reference,
+        None if there's none, listing requires the private key."""
+        response = self.get('/transactions',
+                            params={'reference': reference},
+                            headers={'Authorization': f"Bearer {private_key}"})
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(
+                f"wompi api answered {response.status_code} for reference {reference}",
+                response=response)
+        transactions = response.json().get('data') or []
+        return transactions[0] if transactions else None
+
+    def _fetch_acceptance(self, public_key):
+        response = self.get(f"/merchants/{public_key}")
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(
+                f"wompi api answered {response.status_code} for merchant {public_key}",
+                response=response)
+        acceptance = (response.json().get('data') or {}).get('presigned_acceptance') or {}
+        if not acceptance.get('acceptance_token'):
+            raise requests.exceptions.HTTPError(
+                f"wompi api answered no acceptance token for merchant {public_key}",
+                response=response)
+        return acceptance
+
+    def get_acceptance(self, public_key):
+        """The presigned acceptance of the merchant, with the
+        acceptance_token and the permalink of the terms, shared by every
+        caller of the process until shortly before it expires. Raises
+        requests.exceptions.RequestException on failure."""
+        return acceptance_cache.get_or_load(
+            (self.environment, public_key),
+            lambda: self._fetch_acceptance(public_key), _acceptance_ttl)
+
+    def create_transaction(self, private_key, values):
+        """Create the transaction in wompi, values as the api expects
+        them, acceptance_token included, returns the transaction data.
+        It's a POST, never retried, the reference can't be reused."""
+        response = self.post('/transactions', json=values,
+                             headers={'Authorization': f"Bearer {private_key}"})
+        if response.status_code not in (200, 201):
+            raise requests.exceptions.HTTPError(
+                f"wompi api answered {response.status_code} creating transaction "
+                f"{values.get('reference')}: {response.text[:500]}",
+                response=response)
+        return response.json().get('data')
+
+    def create_payment_source(self, private_key, values):
+        """Create the payment source (card token or nequi), values as
+        the api expects them, acceptance_token included, returns its
+        data, the id is what's charged later."""
+        response = self.post('/payment_sources', json=values,
+                             headers={'Authorization': f"Bearer {private_key}"})
+        if response.status_code not in (200, 201):
+            raise requests.exceptions.HTTPError(
+                f"wompi api answered {response.status_code} creating payment source: "
+                f"{response.text[:500]}",
+                response=response)
+        return response.json().get('data') or {}
+
+    def void_transaction(self, private_key, wompi_id, amount_in_cents=None):
+        """Void the approved card transaction, all of it or only the
+        amount given, returns the data of the void. It's a POST, never
+        retried."""
+        values = {'amount_in_cents': amount_in_cents} if amount_in_cents else {}
+        response = self.post(f"/transactions/{wompi_id}/void", json=values,
+                             headers={'Authorization': f"Bearer {private_key}"})
+        if response.status_code not in (200, 201):
+            raise requests.exceptions.HTTPError(
+                f"wompi api answered {response.status_code} voiding transaction "
+                f"{wompi_id}: {response.text[:500]}",
+                response=response)
+        return response.json().get('data') or {}
+
+    def iter_transactions(self, private_key, date_from, date_to, page_size=200):
+        """Generator of the transactions created in wompi in the date
+        range, fetched one page at a time, so only a page is held in
+        memory, the dates are 'YYYY-MM-DD' strings."""
+        page = 1
+        while True:
+            response = self.get('/transactions',
+                                params={'from_date': date_from,
+                                        'until_date': date_to,
+                                        'page': page,
+                                        'page_size': page_size},
+                                headers={'Authorization': f"Bearer {private_key}"})
+            if response.status_code != 200:
+                raise requests.exceptions.HTTPError(
+                    f"wompi api answered {response.status_code} for transactions page {page}",
+                    response=response)
+            transactions = response.json().get('data') or []
+            for transaction in transactions:
+                yield transaction
+            if len(transactions) < page_size:
+                return
+            page += 1
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(environment):
+    """Return the client of the process for the environment
+    ('prod' or 'test'), created on first use."""
+    environment = 'prod' if environment == 'prod' else 'test'
+    client = _clients.get(environment)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(environment)
+            if client is None:
+                client = _clients[environment] = WompiColClient(environment)
+    return client
+
+
+_limiters = {}
+
+
+def get_rate_limiter(merchant, rate):
+    """Return the rate limiter of the process for the merchant, its
+    calls to the api are limited to rate per second between every
+    thread, created on first use or when the rate changes."""
+    limiter = _limiters.get(merchant)
+    if limiter is None or limiter.rate != rate:
+        with _clients_lock:
+            limiter = _limiters.get(merchant)
+            if limiter is None or limiter.rate != rate:
+                limiter = _limiters[merchant] = RateLimiter(rate)
+    return limiter
+
+
+def reset_clients():
+    """Forget the clients, the next ones are created with the current
+    API_URLS, the cached transactions and acceptances."""
+    with _clients_lock:
+        _clients.clear()
+        _limiters.clear()
+    transactions_cache.clear()
+    acceptance_cache.clear()
@@ -0,0 +1,97 @@
+import logging
+
+from odoo import api, fields, models
+
+from .wompicol_cache import LRUCache
+from .wompicol_client import FINAL_STATUSES
+
+
+_logger = logging.getLogger(__name__)
+
+# Front cache of the keys already committed by this process, and of
+# the last status seen of every wompi transaction.
+_seen_keys = LRUCache(maxsize=10000)
+_seen_ids = LRUCache(maxsize=10000)
+
+
+class PaymentWompicolDedup(models.Model):
+    """Keys of the wompi events already accepted, wompi delivers the
+    same event more than once, only the first one is processed."""
+    _name = 'payment.wompicol.dedup'
+    _description = 'Wompi Colombia Processed Event Key'
+    _log_access = False
+
+    key = fields.Char(string='Key', required=True)
+    wompi_id = fields.Char(string='Wompi Transaction ID')
+    create_date = fields.Datetime(string='Created On', readonly=True)
+
+    _sql_constraints = [
+        ('key_uniq', 'unique(key)', 'The event has already been received.'),
+    ]
+
+    @api.model
+    def _wompicol_key(self, wompi_id, status, sent_at=None):
+        return f"{wompi_id}|{status}|{sent_at or ''}"
+
+    @api.model
+    def _wompicol_register(self, wompi_id, status, sent_at=None):
+        """Register the event, returns False if it was already
+        registered, in which case it should be dropped."""
+        key = self._wompicol_key(wompi_id, status, sent_at)
+        if key in _seen_keys:
+            return False
+        self.env.cr.execute("""
+            INSERT INTO payment_wompicol_dedup (key, wompi_id, create_date)
+            VALUES (%s, %s, now() at time zone 'UTC')
+            ON CONFLICT (key) DO NOTHING
+            RETURNING id
+        """, (key, wompi_id))
+        if not self.env.cr.fetchone():
+            _seen_keys.set(key)
+            return False
+
+        # Only remember it once it's committed, if the processing fails
+        # the row is rolled back, and the event must be accepted again.
+        def remember():
+            _seen_keys.set(key)
+            _seen_ids.set(wompi_id, status)
+        self.env.cr.after('commit', remember)
+        return True
+
+    @api.model
+    def _wompicol_register_event(self, data):
+        """Register the event received on the event url, by its signed
+        timestamp, sent_at isn't part of the signature."""
+        tx_data = data.get('data', {}).get('transaction', {})
+        return self._wompicol_register(tx_data.get('id'),
+                                       tx_data.get('status'),
+                                       data.get('timestamp') or data.get('sent_at'))
+
+    @api.model
+    def _wompicol_forget_event(self, data):
+        """Drop the key of an event registered but rejected, so a later
+        delivery of it is processed."""
+        tx_data = data.get('data', {}).get('transaction', {})
+        wompi_id = tx_data.get('id')
+        key = self._wompicol_key(wompi_id, tx_data.get('status'),
+                                 data.get('timestamp') or data.get('sent_at'))
+        self.env.cr.execute("DELETE FROM payment_wompicol_dedup WHERE key = %s", (key,))
+
+        def forget():
+            _seen_keys.pop(key)
+            _seen_ids.pop(wompi_id)
+        self.env.cr.after('commit', forget)
+
+    @api.model
+    def _wompicol_is_final(self, wompi_id):
+        """Whether this process already committed a final status for
+        the wompi transaction, nothing to update then."""
+        return _seen_ids.get(wompi_id) in FINAL_STATUSES
+
+    @api.model
+    def _cron_gc(self, days=30):
+        """Drop the keys old enough for wompi to not deliver them again."""
+        self.env.cr.execute("""
+            DELETE FROM payment_wompicol_dedup
+            WHERE create_date < (now() at time zone 'UTC') - interval '1 day' * %s
+        """, (days,))
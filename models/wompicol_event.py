@@ -0,0 +1,404 @@
+import datetime
+import json
+import logging
+import re
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo import api, fields, models, SUPERUSER_ID
+from odoo.exceptions import ValidationError
+
+from .wompicol_client import CircuitOpenError
+
+
+_logger = logging.getLogger(__name__)
+
+# What a wompi transaction id looks like, the client return is public
+WOMPI_ID = re.compile(r'^[\w-]{1,64}$')
+
+# Lookups of the client returns are run right away by at most this
+# many threads of the process, each one with its own cursor, the ones
+# that don't fit, or whose worker goes away, are left to the queue cron.
+LOOKUP_WORKERS = 4
+_lookup_slots = threading.BoundedSemaphore(LOOKUP_WORKERS)
+_lookup_executor = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS,
+                                      thread_name_prefix='wompicol_lookup')
+
+
+class TransactionLockedError(Exception):
+    """The transaction is being updated by another worker."""
+
+
+class RetryableEventError(ValidationError):
+    """The event couldn't be processed now, but could later."""
+
+
+class TransactionNotFoundError(RetryableEventError):
+    """No transaction for the event, it may not be committed yet."""
+
+
+class EventNotVerifiedError(RetryableEventError):
+    """Wompi api couldn't be asked to verify the event."""
+
+
+class _DryRun(Exception):
+    """Roll back the replay of the events of a transaction."""
+
+
+class PaymentWompicolEvent(models.Model):
+    """Raw events received from wompi, stored by the event endpoint
+    when the acquirer processes them asynchronously or records them,
+    or when they failed to be processed, and the lookups of the client
+    returns, drained in batches by a cron. Failed events are retried
+    with an exponential backoff, after too many attempts they are left
+    as dead letters, to be re-driven by hand."""
+    _name = 'payment.wompicol.event'
+    _description = 'Wompi Colombia Event'
+    _order = 'id'
+
+    acquirer_id = fields.Many2one('payment.acquirer', string='Acquirer',
+                                  ondelete='cascade')
+    event = fields.Char(string='Event')
+    wompi_id = fields.Char(string='Wompi Transaction ID', index=True)
+    reference = fields.Char(string='Reference')
+    status = fields.Char(string='Wompi Status')
+    sent_at = fields.Char(string='Sent At')
+    test = fields.Boolean(string='Test Event')
+    payload = fields.Text(string='Payload', required=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('dead', 'Dead Letter')],
+        string='State', default='pending', required=True, index=True)
+    error = fields.Text(string='Error')
+    attempts = fields.Integer(string='Attempts', readonly=True)
+    next_attempt = fields.Datetime(string='Next Attempt', index=True)
+    processed_date = fields.Datetime(string='Processed On')
+
+    @api.model
+    def _wompicol_enqueue(self, data, acquirer=None, error=False):
+        """Store the event data as received, to be processed later."""
+        tx_data = data.get('data', {}).get('transaction', {})
+        return self.create({
+            'acquirer_id': acquirer.id if acquirer else False,
+            'event': data.get('event'),
+            'wompi_id': tx_data.get('id'),
+            'reference': tx_data.get('reference'),
+            'status': tx_data.get('status'),
+            'sent_at': data.get('sent_at'),
+            'test': bool(data.get('test')),
+            'payload': json.dumps(data),
+            'error': error,
+        })
+
+    @api.model
+    def _wompicol_enqueue_lookup(self, wompi_id, environment, acquirer=None):
+        """Store the lookup of the transaction a client came back with,
+        left for a minute to the threads before the cron takes it."""
+        return self.create({
+            'acquirer_id': acquirer.id if acquirer else False,
+            'event': 'client_return',
+            'wompi_id': wompi_id,
+            'test': environment == 'test',
+            'payload': json.dumps({'id': wompi_id,
+                                   'environment': environment,
+                                   'acquirer_id': acquirer.id if acquirer else None}),
+            'next_attempt': fields.Datetime.now() + datetime.timedelta(minutes=1),
+        })
+
+    def _wompicol_process_after_commit(self):
+        """Process the events on one of the lookup threads once the
+        current transaction is committed, if there's one free."""
+        event_ids = self.ids
+
+        def run():
+            try:
+                self._wompicol_process_in_thread(event_ids)
+            except Exception:
+                _logger.exception('Wompicol: error processing events %s', event_ids)
+            finally:
+                _lookup_slots.release()
+
+        def start():
+            if _lookup_slots.acquire(blocking=False):
+                _lookup_executor.submit(run)
+
+        self.env.cr.after('commit', start)
+
+    @api.model
+    def _wompicol_record(self, data, acquirer=None):
+        """Keep the event processed right away, to be replayed later."""
+        return self._wompicol_enqueue(data, acquirer).write({
+            'state': 'done',
+            'processed_date': fields.Datetime.now(),
+        })
+
+    @api.model
+    def _wompicol_retry_params(self):
+        ICP = self.env['ir.config_parameter'].sudo()
+        max_attempts = int(ICP.get_param('payment_wompicol.retry_max_attempts', 8))
+        # Minutes before the first retry, doubled on every attempt
+        backoff = int(ICP.get_param('payment_wompicol.retry_backoff', 1))
+        return max_attempts, backoff
+
+    def _wompicol_failed(self, error):
+        """Schedule the retry of the event, or leave it as dead letter
+        if it had too many attempts."""
+        max_attempts, backoff = self._wompicol_retry_params()
+        for event in self:
+            attempts = event.attempts + 1
+            if attempts >= max_attempts:
+                _logger.warning('Wompicol: event %s dead after %s attempts: %s', event.id, attempts, error)
+                event.write({'state': 'dead', 'attempts': attempts, 'error': error})
+            else:
+                delay = datetime.timedelta(minutes=backoff * 2 ** (attempts - 1))
+                event.write({'attempts': attempts,
+                             'error': error,
+                             'next_attempt': fields.Datetime.now() + delay})
+
+    def _wompicol_process(self, commit=False):
+        """Run the event through form_feedback, each event on its own
+        savepoint so a failure doesn't affect the others, committed
+        after each one if commit is set. If the wompi api is down the
+        rest of the events are left pending, if an event fails or its
+        transaction is locked by another worker, the rest of the events
+        of its transaction, to keep them in order."""
+        blocked = set()
+        Transaction = self.env['payment.transaction'].sudo().with_context(
+                wompicol_queue=True)
+        for event in self:
+            if event.wompi_id and event.wompi_id in blocked:
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    if event.event == 'client_return':
+                        lookup = json.loads(event.payload)
+                        Transaction._wompicol_get_data_manually(
+                                lookup['id'], lookup['environment'], lookup.get('acquirer_id'))
+                    else:
+                        Transaction.form_feedback(json.loads(event.payload), 'wompicol')
+            except TransactionLockedError as e:
+                _logger.info('Wompicol: transaction of event %s locked, deferring it', event.id)
+                event.write({'error': str(e)})
+                blocked.add(event.wompi_id)
+            except CircuitOpenError as e:
+                _logger.info('Wompicol: wompi api unavailable, deferring queued events')
+                event.write({'error': str(e)})
+                if commit:
+                    self.env.cr.commit()
+                break
+            except Exception as e:
+                _logger.warning('Wompicol: processing of event %s failed: %s', event.id, e)
+                event._wompicol_failed(str(e))
+                blocked.add(event.wompi_id)
+            else:
+                event.write({'state': 'done',
+                             'error': False,
+                             'next_attempt': False,
+                             'processed_date': fields.Datetime.now()})
+            if commit:
+                self.env.cr.commit()
+
+    def action_wompicol_redrive(self):
+        """Send the events back to the queue, as new."""
+        self.write({'state': 'pending',
+                    'attempts': 0,
+                    'next_attempt': False,
+                    'error': False})
+        return True
+
+    @api.model
+    def _wompicol_due_events(self, limit):
+        """Pending events to process now, the ones of a transaction with
+        an earlier event waiting for its retry are left for later."""
+        now = fields.Datetime.now()
+        events = self.search([
+            ('state', '=', 'pending'),
+            '|', ('next_attempt', '=', False), ('next_attempt', '<=', now),
+        ], limit=limit)
+        waiting = self.search([
+            ('state', '=', 'pending'),
+            ('next_attempt', '>', now),
+            ('wompi_id', 'in', [wompi_id for wompi_id in events.mapped('wompi_id') if wompi_id]),
+        ])
+        first_waiting = {}
+        for event in waiting:
+            first_waiting.setdefault(event.wompi_id, event.id)
+        return events.filtered(
+            lambda event: event.id < first_waiting.get(event.wompi_id, event.id + 1))
+
+    def _wompicol_group_by_transaction(self):
+        """Split the events in lists of ids, one per wompi transaction,
+        each one in arrival order, events of a transaction must never
+        be processed out of order or at the same time."""
+        groups = {}
+        for event in self.sorted('id'):
+            key = event.wompi_id or 'event-%s' % event.id
+            groups.setdefault(key, []).append(event.id)
+        return list(groups.values())
+
+    @api.model
+    def _wompicol_deal(self, groups, workers):
+        """Deal the groups of ids between the workers, so every worker
+        opens a single cursor, the groups are kept whole."""
+        buckets = [[] for i in range(min(workers, len(groups)))]
+        for i, group in enumerate(groups):
+            buckets[i % len(buckets)].extend(group)
+        return buckets
+
+    def _wompicol_process_in_thread(self, event_ids):
+        """Process the events on a new cursor, committing each one."""
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env[self._name].browse(event_ids)._wompicol_process(commit=True)
+
+    @api.model
+    def _wompicol_queue_params(self):
+        ICP = self.env['ir.config_parameter'].sudo()
+        batch_size = int(ICP.get_param('payment_wompicol.queue_batch_size', 200))
+        workers = int(ICP.get_param('payment_wompicol.queue_workers', 1))
+        return batch_size, max(workers, 1)
+
+    @api.model
+    def _cron_process_queue(self):
+        """Drain a batch of pending events, the events of a transaction
+        are always processed in order by the same worker, transactions
+        are spread between the configured number of workers."""
+        batch_size, workers = self._wompicol_queue_params()
+        events = self._wompicol_due_events(batch_size)
+        if not events:
+            return
+        _logger.info('Wompicol: processing %s queued events with %s workers', len(events), workers)
+        groups = events._wompicol_group_by_transaction()
+        if workers == 1 or len(groups) == 1 \
+           or getattr(threading.currentThread(), 'testing', False):
+            events._wompicol_process()
+            return
+        buckets = self._wompicol_deal(groups, workers)
+        # The rows are read by the other cursors, make sure they see
+        # the same as this one.
+        self.env.cr.commit()
+        with ThreadPoolExecutor(max_workers=len(buckets)) as executor:
+            # Consume the results so errors of the workers are raised
+            list(executor.map(self._wompicol_process_in_thread, buckets))
+        self.invalidate_cache()
+
+    @api.model
+    def _wompicol_replay(self, date_from, date_to, dry_run=True, verify=True,
+                         acquirer=None, workers=None):
+        """Replay the events received in the window, in pages, in the
+        order they were received, as form_feedback gets them. The
+        transactions are spread between the workers, the events of a
+        transaction are always replayed in order by the same one. With
+        dry_run nothing is written, only the differences between the
+        state of the transactions before and after are computed. With
+        verify False the events aren't verified again. The events
+        themselves are left as they are. Returns a summary, with the
+        differences and errors of every transaction."""
+        batch_size, default_workers = self._wompicol_queue_params()
+        workers = max(workers or default_workers, 1)
+        testing = getattr(threading.currentThread(), 'testing', False)
+        domain = [('create_date', '>=', date_from), ('create_date', '<', date_to),
+                  ('event', '!=', 'client_return')]
+        if acquirer:
+            domain.append(('acquirer_id', '=', acquirer.id))
+        summary = {'events': 0, 'transactions': 0, 'changed': 0, 'errors': 0, 'diffs': []}
+        last_id = 0
+        while True:
+            events = self.search(domain + [('id', '>', last_id)], order='id', limit=batch_size)
+            if not events:
+                break
+            last_id = events[-1].id
+            groups = events._wompicol_group_by_transaction()
+            if workers == 1 or len(groups) == 1 or testing:
+                diffs = events._wompicol_replay_events(dry_run, verify)
+                if not dry_run and not testing:
+                    self.env.cr.commit()
+            else:
+                buckets = self._wompicol_deal(groups, workers)
+                with ThreadPoolExecutor(max_workers=len(buckets)) as executor:
+                    diffs = [diff for bucket in executor.map(
+                                 lambda bucket: self._wompicol_replay_in_thread(bucket, dry_run, verify),
+                                 buckets)
+                             for diff in bucket]
+            summary['events'] += len(events)
+            summary['transactions'] += len(diffs)
+            for diff in diffs:
+                if diff['error']:
+                    summary['errors'] += 1
+                if diff['before'] != diff['after']:
+                    summary['changed'] += 1
+                if diff['error'] or diff['before'] != diff['after']:
+                    summary['diffs'].append(diff)
+            self.invalidate_cache()
+        _logger.info('Wompicol: %s %s events of %s transactions, %s changed, %s errors',
+                     'dry run of' if dry_run else 'replayed', summary['events'],
+                     summary['transactions'], summary['changed'], summary['errors'])
+        return summary
+
+    def _wompicol_replay_in_thread(self, event_ids, dry_run, verify):
+        """Replay the events on a new cursor, rolled back on dry run."""
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            diffs = env[self._name].browse(event_ids)._wompicol_replay_events(dry_run, verify)
+            if dry_run:
+                cr.rollback()
+            return diffs
+
+    def _wompicol_replay_events(self, dry_run, verify):
+        """Replay the events, transaction by transaction, returns the
+        difference of each one."""
+        return [self.browse(event_ids)._wompicol_replay_transaction(dry_run, verify)
+                for event_ids in self._wompicol_group_by_transaction()]
+
+    def _wompicol_replay_transaction(self, dry_run, verify):
+        """Replay the events of a single transaction in order, stopping
+        at the first one that fails, as the queue does."""
+        Transaction = self.env['payment.transaction'].sudo().with_context(
+                wompicol_queue=True)
+        tx = Transaction._wompicol_search_reference(
+                self[0].reference, json.loads(self[0].payload).get('acquirer_id')) \
+            if self[0].reference else Transaction
+
+        def snapshot():
+            if len(tx) != 1:
+                return None
+            return {'state': tx.state,
+                    'acquirer_reference': tx.acquirer_reference,
+                    'is_processed': tx.is_processed}
+
+        diff = {'wompi_id': self[0].wompi_id,
+                'reference': self[0].reference,
+                'transaction_id': tx.id if len(tx) == 1 else False,
+                'events': len(self),
+                'before': snapshot(),
+                'after': None,
+                'error': None}
+
+        def replay():
+            for event in self:
+                data = json.loads(event.payload)
+                if not verify:
+                    data['noconfirm'] = True
+                try:
+                    with self.env.cr.savepoint():
+                        Transaction.form_feedback(data, 'wompicol')
+                except Exception as e:
+                    diff['error'] = f"event {event.id}: {e}"
+                    break
+            diff['after'] = snapshot()
+
+        if not dry_run:
+            replay()
+            return diff
+        try:
+            with self.env.cr.savepoint():
+                replay()
+                Transaction.flush()
+                raise _DryRun()
+        except _DryRun:
+            pass
+        # Forget what was read from the rolled back savepoint
+        Transaction.invalidate_cache()
+        return diff
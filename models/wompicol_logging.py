@@ -0,0 +1,77 @@
+import pprint
+import random
+import re
+
+
+# Keys of the wompi payloads holding personal data
+REDACTED_KEYS = frozenset([
+    'customer_email', 'email', 'phone_number', 'phone', 'legal_id',
+    'full_name', 'contact_name', 'customer_data', 'shipping_address',
+    'billing_data',
+])
+_EMAIL = re.compile(r'[^@\s"\']+@[^@\s"\']+')
+
+
+def _mask(value):
+    if not isinstance(value, str):
+        return '***'
+    if len(value) <= 4:
+        return '***'
+    return value[:2] + '***' + value[-2:]
+
+
+def redact(payload):
+    """Copy of the payload with the personal data masked."""
+    if isinstance(payload, dict):
+        return {key: _mask(value) if key in REDACTED_KEYS and value else redact(value)
+                for key, value in payload.items()}
+    if isinstance(payload, list):
+        return [redact(value) for value in payload]
+    if isinstance(payload, str):
+        return _EMAIL.sub('***', payload)
+    return payload
+
+
+def sample_rate(env):
+    """Share (0 to 1) of the payloads logged in full, from the
+    payment_wompicol.log_sample_rate system parameter."""
+    return float(env['ir.config_parameter'].sudo().get_param(
+        'payment_wompicol.log_sample_rate', 0))
+
+
+class LazyPayload(object):
+    """Log argument for a wompi payload, only formatted if the record is
+    emitted, as a short summary, or the full payload redacted."""
+
+    __slots__ = ('payload', 'full')
+
+    def __init__(self, payload, full=False):
+        self.payload = payload
+        self.full = full
+
+    def summary(self):
+        payload = self.payload if isinstance(self.payload, dict) else {}
+        tx_data = payload.get('data', {})
+        if isinstance(tx_data, dict):
+            tx_data = tx_data.get('transaction', tx_data)
+        if not isinstance(tx_data, dict):
+            tx_data = {}
+        return 'event=%s id=%s reference=%s status=%s sent_at=%s' % (
+            payload.get('event'), tx_data.get('id'), tx_data.get('reference'),
+            tx_data.get('status'), payload.get('sent_at'))
+
+    def __str__(self):
+        if self.full:
+            return pprint.pformat(redact(self.payload))
+        return self.summary()
+
+
+def payload(data, sample_rate=0):
+    """Log argument for the payload, a summary, or for a sample_rate
+    (0 to 1) share of the calls the full redacted payload."""
+    return LazyPayload(data, full=bool(sample_rate) and random.random() < sample_rate)
+
+
+def dump(data):
+    """Log argument for the full redacted payload, for failures."""
+    return LazyPayload(data, full=True)
@@ -0,0 +1,134 @@
+import cProfile
+import functools
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+_logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histograms, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_help = {
+    'wompicol_events_total': 'Wompi events received, by status.',
+    'wompicol_verifications_total': 'Wompi event verifications, by mode and outcome.',
+    'wompicol_api_responses_total': 'Wompi api responses, by environment and status code.',
+    'wompicol_api_seconds': 'Wompi api call latency, by environment.',
+    'wompicol_stage_seconds': 'Time spent on each stage of the processing of an event.',
+    'wompicol_charge_seconds': 'Time from the creation to the final status of a token charge, by outcome.',
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Increment the counter with the labels."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """Add an observation to the histogram with the labels."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+@contextmanager
+def span(stage):
+    """Time the stage of the processing of an event."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('wompicol_stage_seconds', time.perf_counter() - start, stage=stage)
+
+
+def timed(stage):
+    """Decorator timing the calls as a stage of the processing."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profile(name, sample_rate):
+    """Profile the block for a sample_rate (0 to 1) share of the calls,
+    logging the most expensive functions."""
+    if not sample_rate or random.random() >= sample_rate:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(25)
+        _logger.info('Wompicol: profile of %s\n%s', name, stream.getvalue())
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in labels)
+
+
+def render():
+    """The metrics of this process in the prometheus text format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, dict(value, buckets=list(value['buckets'])))
+                            for key, value in _histograms.items())
+    lines = []
+    declared = set()
+
+    def declare(name, kind):
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# HELP {name} {_help.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        declare(name, 'counter')
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), histogram in histograms:
+        declare(name, 'histogram')
+        for bound, count in zip(BUCKETS, histogram['buckets']):
+            lines.append(f"{name}_bucket{_labels(labels, [('le', str(bound))])} {count}")
+        lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+        lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
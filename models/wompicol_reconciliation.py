@@ -0,0 +1,211 @@
+import datetime
+import logging
+import math
+
+from psycopg2.extras import execute_values
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+from .wompicol_client import FINAL_STATUSES
+
+
+_logger = logging.getLogger(__name__)
+
+# State the transaction should have for each wompi status
+WOMPI_STATES = {
+    'APPROVED': 'done',
+    'PENDING': 'pending',
+    'DECLINED': 'cancel',
+    'VOIDED': 'cancel',
+    'ERROR': 'cancel',
+}
+
+# Report lines created per insert
+CHUNK_SIZE = 1000
+
+# Columns of the report lines, in insert order
+LINE_COLUMNS = ('kind', 'transaction_id', 'wompi_id', 'reference', 'amount',
+                'wompi_amount', 'state', 'wompi_status')
+
+
+class PaymentWompicolReconciliation(models.Model):
+    """Comparison of the transactions recorded by wompi in a date
+    range against the transactions of the acquirer."""
+    _name = 'payment.wompicol.reconciliation'
+    _description = 'Wompi Colombia Reconciliation'
+    _order = 'id desc'
+
+    name = fields.Char(string='Name', compute='_compute_name')
+    acquirer_id = fields.Many2one('payment.acquirer', string='Acquirer', required=True,
+                                  domain=[('provider', '=', 'wompicol')],
+                                  ondelete='cascade')
+    date_from = fields.Date(string='From', required=True)
+    date_to = fields.Date(string='To', required=True)
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('done', 'Done')],
+        string='State', default='draft', required=True)
+    wompi_count = fields.Integer(string='Wompi Transactions', readonly=True)
+    matched_count = fields.Integer(string='Matched', readonly=True)
+    line_ids = fields.One2many('payment.wompicol.reconciliation.line', 'reconciliation_id',
+                               string='Mismatches', readonly=True)
+
+    @api.depends('acquirer_id', 'date_from', 'date_to')
+    def _compute_name(self):
+        for reconciliation in self:
+            reconciliation.name = f"{reconciliation.acquirer_id.name} {reconciliation.date_from} - {reconciliation.date_to}"
+
+    def _wompicol_build_index(self):
+        """Index of the transactions of the acquirer that could be in
+        the range, by wompi id and by wompi reference or odoo reference,
+        values are (id, amount in cents, state, in range, voided)."""
+        date_from = datetime.datetime.combine(self.date_from, datetime.time.min)
+        date_to = datetime.datetime.combine(self.date_to, datetime.time.max)
+        # Transactions created close to the limits may be dated on the
+        # other side by wompi
+        margin = datetime.timedelta(days=1)
+        self.env.cr.execute("""
+            SELECT id, acquirer_reference, wompicol_reference, reference, amount, state, create_date,
+                   wompicol_voided
+            FROM payment_transaction
+            WHERE acquirer_id = %s AND create_date BETWEEN %s AND %s
+        """, (self.acquirer_id.id, date_from - margin, date_to + margin))
+        by_id = {}
+        by_reference = {}
+        for tx_id, wompi_id, wompi_reference, reference, amount, state, create_date, voided \
+                in self.env.cr.fetchall():
+            entry = (tx_id, math.ceil(amount) * 100, state, date_from <= create_date <= date_to,
+                     bool(voided))
+            if wompi_id:
+                by_id[wompi_id] = entry
+            if reference:
+                by_reference.setdefault(reference, entry)
+            if wompi_reference:
+                by_reference[wompi_reference] = entry
+        return by_id, by_reference
+
+    @api.model
+    def _wompicol_lookup(self, wompi_tx, by_id, by_reference):
+        """Entry of the index for the wompi transaction, if any."""
+        reference = wompi_tx.get('reference')
+        entry = by_id.get(wompi_tx.get('id')) or by_reference.get(reference)
+        if not entry and reference and '_' in reference:
+            # Reference of a previous attempt, the odoo one
+            entry = by_reference.get(reference.rsplit('_', 1)[0])
+        return entry
+
+    def _wompicol_compare(self, wompi_tx, entry):
+        """Report line values if the wompi transaction and the odoo one
+        don't match, None if they do."""
+        line = {
+            'reconciliation_id': self.id,
+            'wompi_id': wompi_tx.get('id'),
+            'reference': wompi_tx.get('reference'),
+            'wompi_amount': (wompi_tx.get('amount_in_cents') or 0) / 100,
+            'wompi_status': wompi_tx.get('status'),
+        }
+        if not entry:
+            return dict(line, kind='missing_odoo')
+        tx_id, amount_cents, state, in_range, voided = entry
+        line.update(transaction_id=tx_id, amount=amount_cents / 100, state=state)
+        if wompi_tx.get('amount_in_cents') != amount_cents:
+            return dict(line, kind='amount')
+        status = wompi_tx.get('status')
+        # Voided transactions stay done, their payment is reversed
+        if status == 'VOIDED' and state == 'done' and voided:
+            return None
+        if status in FINAL_STATUSES and WOMPI_STATES.get(status) != state:
+            return dict(line, kind='status')
+        return None
+
+    def _wompicol_flush(self, lines):
+        """Insert the report lines in a few statements, like the lines
+        of the settlements, there can be many of them."""
+        if not lines:
+            return
+        now = fields.Datetime.now()
+        execute_values(self.env.cr, """
+            INSERT INTO payment_wompicol_reconciliation_line (
+                reconciliation_id, %s,
+                create_uid, create_date, write_uid, write_date)
+            VALUES %%s
+        """ % ', '.join(LINE_COLUMNS),
+            [(line['reconciliation_id'],) + tuple(line.get(column) for column in LINE_COLUMNS)
+             + (self.env.uid, now, self.env.uid, now)
+             for line in lines], page_size=CHUNK_SIZE)
+        self.invalidate_cache(['line_ids'], self.ids)
+        lines.clear()
+
+    def action_run(self):
+        """Stream the transactions of wompi in the range, matching each
+        one against the index, writing the mismatches in chunks."""
+        for reconciliation in self:
+            acquirer = reconciliation.acquirer_id
+            private_key = acquirer._get_keys()[0]
+            if not private_key:
+                raise UserError(_('WompiCol: the acquirer has no private key.'))
+            reconciliation.line_ids.unlink()
+            by_id, by_reference = reconciliation._wompicol_build_index()
+            seen = set()
+            lines = []
+            wompi_count = matched_count = 0
+            for wompi_tx in acquirer._get_wompicol_client().iter_transactions(
+                    private_key,
+                    fields.Date.to_string(reconciliation.date_from),
+                    fields.Date.to_string(reconciliation.date_to)):
+                wompi_count += 1
+                entry = reconciliation._wompicol_lookup(wompi_tx, by_id, by_reference)
+                if entry:
+                    seen.add(entry[0])
+                line = reconciliation._wompicol_compare(wompi_tx, entry)
+                if line:
+                    lines.append(line)
+                    if len(lines) >= CHUNK_SIZE:
+                        reconciliation._wompicol_flush(lines)
+                else:
+                    matched_count += 1
+
+            # Paid in odoo, but wompi doesn't know about them
+            missing = {entry[0]: entry for entry in list(by_id.values()) + list(by_reference.values())
+                       if entry[3] and entry[2] == 'done' and entry[0] not in seen}
+            for tx_id, amount_cents, state, in_range, voided in missing.values():
+                lines.append({
+                    'reconciliation_id': reconciliation.id,
+                    'kind': 'missing_wompi',
+                    'transaction_id': tx_id,
+                    'amount': amount_cents / 100,
+                    'state': state,
+                })
+                if len(lines) >= CHUNK_SIZE:
+                    reconciliation._wompicol_flush(lines)
+            reconciliation._wompicol_flush(lines)
+
+            _logger.info('Wompicol: reconciliation %s, %s wompi transactions, %s matched',
+                         reconciliation.id, wompi_count, matched_count)
+            reconciliation.write({'state': 'done',
+                                  'wompi_count': wompi_count,
+                                  'matched_count': matched_count})
+        return True
+
+
+class PaymentWompicolReconciliationLine(models.Model):
+    _name = 'payment.wompicol.reconciliation.line'
+    _description = 'Wompi Colombia Reconciliation Mismatch'
+    _order = 'id'
+
+    reconciliation_id = fields.Many2one('payment.wompicol.reconciliation', string='Reconciliation',
+                                        required=True, ondelete='cascade', index=True)
+    kind = fields.Selection([
+        ('missing_odoo', 'Missing in Odoo'),
+        ('missing_wompi', 'Missing in Wompi'),
+        ('amount', 'Amount Differs'),
+        ('status', 'Status Differs')],
+        string='Mismatch', required=True)
+    transaction_id = fields.Many2one('payment.transaction', string='Transaction')
+    wompi_id = fields.Char(string='Wompi Transaction ID')
+    reference = fields.Char(string='Wompi Reference')
+    amount = fields.Float(string='Amount')
+    wompi_amount = fields.Float(string='Wompi Amount')
+    state = fields.Char(string='State')
+    wompi_status = fields.Char(string='Wompi Status')
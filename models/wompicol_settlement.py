@@ -0,0 +1,278 @@
+import base64
+import csv
+import io
+import itertools
+import logging
+import re
+
+from psycopg2.extras import execute_values
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+
+_logger = logging.getLogger(__name__)
+
+# Names the columns of the wompi settlement and payout exports may have,
+# lowercased, the first one found in the header is used.
+SETTLEMENT_COLUMNS = {
+    'wompi_id': ('transaction_id', 'id transaccion', 'id_transaccion', 'id'),
+    'reference': ('reference', 'referencia'),
+    'amount': ('amount_in_cents', 'monto_en_centavos', 'amount', 'monto'),
+    'fee': ('fee_in_cents', 'comision_en_centavos', 'fee', 'comision'),
+    'tax': ('tax_in_cents', 'iva_en_centavos', 'tax', 'iva'),
+}
+# Columns holding cents, the others hold pesos.
+CENTS_COLUMNS = frozenset([
+    'amount_in_cents', 'monto_en_centavos', 'fee_in_cents',
+    'comision_en_centavos', 'tax_in_cents', 'iva_en_centavos',
+])
+
+# Lines read, matched and inserted at a time
+CHUNK_SIZE = 5000
+# Bytes of the base64 upload decoded at a time, a multiple of 4
+DECODE_SIZE = 64 * 1024
+
+
+# Colombian format of the peso columns, '.' for the thousands and ','
+# for the decimals, 1.500.000,50
+PESOS = re.compile(r'^-?(\d{1,3}(\.\d{3})+|\d+)(,\d+)?$')
+
+
+def _parse_cents(value):
+    """Amount of a cents column, a plain integer, in cents."""
+    value = (value or '').strip()
+    if not value:
+        return 0.0
+    return float(int(value))
+
+
+def _parse_pesos(value):
+    """Amount of a peso column, in pesos."""
+    value = (value or '').strip().replace('$', '').replace(' ', '')
+    if not value:
+        return 0.0
+    if not PESOS.match(value):
+        raise ValueError(value)
+    return float(value.replace('.', '').replace(',', '.'))
+
+
+class _Base64Reader(io.RawIOBase):
+    """Binary file object decoding the base64 data as it's read, the
+    upload isn't decoded whole in memory."""
+
+    def __init__(self, data):
+        super().__init__()
+        if isinstance(data, str):
+            data = data.encode()
+        self._source = io.BytesIO(data)
+        self._pending = b''
+        self._decoded = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._decoded:
+            chunk = self._source.read(DECODE_SIZE)
+            if not chunk and not self._pending:
+                return 0
+            # Whitespace is dropped, decoded by groups of 4 characters
+            self._pending += b''.join(chunk.split())
+            size = len(self._pending) if not chunk else len(self._pending) // 4 * 4
+            self._decoded = base64.decodebytes(self._pending[:size])
+            self._pending = self._pending[size:]
+        size = min(len(buffer), len(self._decoded))
+        buffer[:size] = self._decoded[:size]
+        self._decoded = self._decoded[size:]
+        return size
+
+
+class PaymentWompicolSettlement(models.Model):
+    """Settlement or payout export of wompi imported to match its lines
+    with the transactions."""
+    _name = 'payment.wompicol.settlement'
+    _description = 'Wompi Colombia Settlement'
+    _order = 'id desc'
+
+    name = fields.Char(string='File', required=True)
+    acquirer_id = fields.Many2one('payment.acquirer', string='Acquirer', required=True,
+                                  ondelete='cascade')
+    line_count = fields.Integer(string='Lines', readonly=True)
+    matched_count = fields.Integer(string='Matched', readonly=True)
+    amount = fields.Float(string='Amount', readonly=True)
+    fee = fields.Float(string='Fees', readonly=True)
+    tax = fields.Float(string='Taxes', readonly=True)
+    net = fields.Float(string='Net', readonly=True)
+    line_ids = fields.One2many('payment.wompicol.settlement.line', 'settlement_id',
+                               string='Lines', readonly=True)
+
+    def _wompicol_build_index(self, wompi_ids, references):
+        """Transaction ids of the acquirer by wompi id, by wompi reference
+        and by reference, only of the ids and references of a chunk,
+        built with a single query."""
+        wompi_ids = list({wompi_id for wompi_id in wompi_ids if wompi_id})
+        references = {reference for reference in references if reference}
+        # Reference of a previous attempt, the odoo one
+        references |= {reference.rsplit('_', 1)[0] for reference in references if '_' in reference}
+        references = list(references)
+        if not wompi_ids and not references:
+            return {}, {}
+        self.env.cr.execute("""
+            SELECT id, acquirer_reference, wompicol_reference, reference
+            FROM payment_transaction
+            WHERE acquirer_id = %s
+              AND (acquirer_reference = ANY(%s)
+                   OR wompicol_reference = ANY(%s)
+                   OR reference = ANY(%s))
+        """, (self.acquirer_id.id, wompi_ids, references, references))
+        by_id = {}
+        by_reference = {}
+        for tx_id, wompi_id, wompi_reference, reference in self.env.cr.fetchall():
+            if wompi_id:
+                by_id[wompi_id] = tx_id
+            if reference:
+                by_reference.setdefault(reference, tx_id)
+            if wompi_reference:
+                by_reference[wompi_reference] = tx_id
+        return by_id, by_reference
+
+    @api.model
+    def _wompicol_columns(self, header):
+        """Index of each known column in the header."""
+        header = [name.strip().lower() for name in header]
+        columns = {}
+        for column, names in SETTLEMENT_COLUMNS.items():
+            for name in names:
+                if name in header:
+                    columns[column] = (header.index(name), name in CENTS_COLUMNS)
+                    break
+        if 'amount' not in columns or ('wompi_id' not in columns and 'reference' not in columns):
+            raise UserError(_('WompiCol: the file needs an amount column, and a transaction id or reference column, found: %s') % ', '.join(header))
+        return columns
+
+    def _wompicol_match(self, rows, columns, line_numbers=None):
+        """Line values of a chunk of rows, the amounts of each column
+        parsed at once, matched with the index of the chunk."""
+        line_numbers = line_numbers or range(1, len(rows) + 1)
+
+        def column(name):
+            if name not in columns:
+                return [None] * len(rows)
+            index, cents = columns[name]
+            values = [row[index] if index < len(row) else '' for row in rows]
+            if name in ('wompi_id', 'reference'):
+                return [value.strip() or None for value in values]
+            parse, divisor = (_parse_cents, 100.0) if cents else (_parse_pesos, 1.0)
+            amounts = []
+            for line_number, value in zip(line_numbers, values):
+                try:
+                    amounts.append(parse(value) / divisor)
+                except ValueError:
+                    raise UserError(_('WompiCol: invalid %s "%s" on line %s of the file.')
+                                    % (name, value, line_number))
+            return amounts
+
+        wompi_ids, references = column('wompi_id'), column('reference')
+        amounts, fees, taxes = column('amount'), column('fee'), column('tax')
+        fees = [fee or 0.0 for fee in fees]
+        taxes = [tax or 0.0 for tax in taxes]
+        nets = [amount - fee - tax for amount, fee, tax in zip(amounts, fees, taxes)]
+        by_id, by_reference = self._wompicol_build_index(wompi_ids, references)
+        tx_ids = []
+        for wompi_id, reference in zip(wompi_ids, references):
+            tx_id = by_id.get(wompi_id) or by_reference.get(reference)
+            if not tx_id and reference and '_' in reference:
+                # Reference of a previous attempt, the odoo one
+                tx_id = by_reference.get(reference.rsplit('_', 1)[0])
+            tx_ids.append(tx_id)
+        return list(zip(tx_ids, wompi_ids, references, amounts, fees, taxes, nets))
+
+    def _wompicol_insert(self, lines):
+        """Insert the lines of a chunk in a few statements, they are
+        plain rows, creating them one by one through the orm is too slow
+        for the size of the exports."""
+        now = fields.Datetime.now()
+        execute_values(self.env.cr, """
+            INSERT INTO payment_wompicol_settlement_line (
+                settlement_id, transaction_id, wompi_id, reference,
+                amount, fee, tax, net,
+                create_uid, create_date, write_uid, write_date)
+            VALUES %s
+        """, [(self.id,) + line + (self.env.uid, now, self.env.uid, now)
+              for line in lines], page_size=1000)
+
+    def _wompicol_import(self, fileobj, encoding='utf-8-sig'):
+        """Read the csv export from the binary file object in chunks,
+        only a chunk of lines is held in memory, the BOM excel writes
+        at the start is dropped."""
+        self.ensure_one()
+        text = io.TextIOWrapper(fileobj, encoding=encoding, newline='')
+        sample = text.readline()
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+        except csv.Error:
+            raise UserError(_('WompiCol: the file is not a csv export, could not find the delimiter of its header: %s') % sample.strip()[:200])
+        columns = self._wompicol_columns(next(csv.reader([sample], dialect)))
+        reader = csv.reader(text, dialect)
+
+        totals = {'line_count': 0, 'matched_count': 0, 'amount': 0.0, 'fee': 0.0, 'tax': 0.0, 'net': 0.0}
+        while True:
+            # The header was read before the reader, line numbers of the file
+            numbered = [(reader.line_num + 1, row)
+                        for row in itertools.islice(reader, CHUNK_SIZE) if any(row)]
+            if not numbered:
+                break
+            line_numbers, rows = zip(*numbered)
+            lines = self._wompicol_match(rows, columns, line_numbers)
+            self._wompicol_insert(lines)
+            totals['line_count'] += len(lines)
+            totals['matched_count'] += sum(1 for line in lines if line[0])
+            totals['amount'] += sum(line[3] for line in lines)
+            totals['fee'] += sum(line[4] for line in lines)
+            totals['tax'] += sum(line[5] for line in lines)
+            totals['net'] += sum(line[6] for line in lines)
+        text.detach()
+        self.write(totals)
+        self.invalidate_cache(['line_ids'], self.ids)
+        _logger.info('Wompicol: settlement %s imported, %s lines, %s matched',
+                     self.name, totals['line_count'], totals['matched_count'])
+        return True
+
+
+class PaymentWompicolSettlementLine(models.Model):
+    _name = 'payment.wompicol.settlement.line'
+    _description = 'Wompi Colombia Settlement Line'
+    _order = 'id'
+
+    settlement_id = fields.Many2one('payment.wompicol.settlement', string='Settlement',
+                                    required=True, ondelete='cascade', index=True)
+    transaction_id = fields.Many2one('payment.transaction', string='Transaction', index=True)
+    wompi_id = fields.Char(string='Wompi Transaction ID')
+    reference = fields.Char(string='Reference')
+    amount = fields.Float(string='Amount')
+    fee = fields.Float(string='Fee')
+    tax = fields.Float(string='Tax')
+    net = fields.Float(string='Net')
+
+
+class PaymentWompicolSettlementImport(models.TransientModel):
+    _name = 'payment.wompicol.settlement.import'
+    _description = 'Wompi Colombia Settlement Import'
+
+    acquirer_id = fields.Many2one('payment.acquirer', string='Acquirer', required=True,
+                                  domain=[('provider', '=', 'wompicol')])
+    data = fields.Binary(string='File', required=True)
+    filename = fields.Char(string='File Name')
+
+    def action_import(self):
+        self.ensure_one()
+        settlement = self.acquirer_id.wompicol_import_settlement(
+                io.BufferedReader(_Base64Reader(self.data)),
+                self.filename or _('Settlement'))
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'payment.wompicol.settlement',
+            'res_id': settlement.id,
+            'view_mode': 'form',
+        }
@@ -1,8 +1,13 @@
-odoo.define("payment_wompicol.payment_form", ['web.public.widget', 'payment.payment_form'], function (require) {
+odoo.define("payment_wompicol.payment_form", ['web.ajax', 'web.core', 'web.public.widget', 'payment.payment_form'], function (require) {
     'use strict';
 
+    var ajax = require('web.ajax');
+    var core = require('web.core');
     var PaymentForm = require('payment.payment_form');
     var publicWidget = require('web.public.widget');
+
+    var _t = core._t;
+    var WIDGET_URL = 'https://checkout.wompi.co/widget.js';
     PaymentForm.include({
         payEvent: function (ev) {
             ev.preventDefault();
@@ -16,6 +21,91 @@ odoo.define("payment_wompicol.payment_form", ['web.public.widget', 'payment.paym
                 return this._super.apply(this, arguments);
             }
         },
+        /**
+         * Get the state of the transaction with the reference, the
+         * promise resolves to null if it didn't change since the last call.
+         */
+        _wompicolGetStatus: function (reference) {
+            var self = this;
+            this._wompicolEtags = this._wompicolEtags || {};
+            return new Promise(function (resolve, reject) {
+                $.ajax({
+                    url: '/payment/wompicol/status/' + encodeURIComponent(reference),
+                    headers: self._wompicolEtags[reference] ? {'If-None-Match': self._wompicolEtags[reference]} : {},
+                    dataType: 'json',
+                }).done(function (data, textStatus, jqXHR) {
+                    if (jqXHR.status === 304) {
+                        return resolve(null);
+                    }
+                    self._wompicolEtags[reference] = jqXHR.getResponseHeader('ETag');
+                    resolve(data);
+                }).fail(reject);
+            });
+        },
+        /**
+         * Poll the state of the transaction until it leaves draft, or
+         * the attempts run out, the promise resolves to the last state.
+         */
+        _wompicolWaitStatus: function (reference, attempts) {
+            var self = this;
+            attempts = attempts === undefined ? 30 : attempts;
+            return this._wompicolGetStatus(reference).then(function (status) {
+                if ((status && status.state !== 'draft') || attempts <= 0) {
+                    return status;
+                }
+                return new Promise(function (resolve) {
+                    setTimeout(resolve, 1000);
+                }).then(function () {
+                    return self._wompicolWaitStatus(reference, attempts - 1);
+                });
+            }, function () {
+                return null;
+            });
+        },
+        /**
+         * Open the wompi widget on the page with the values of the
+         * wompicol_form, instead of redirecting to the checkout.
+         */
+        _wompicolOpenWidget: function (form, button) {
+            var self = this;
+            var value = function (name) {
+                return $(form).find('input[name="' + name + '"]').val();
+            };
+            return ajax.loadJS(WIDGET_URL).then(function () {
+                var checkout = new WidgetCheckout({
+                    currency: value('currency'),
+                    amountInCents: parseInt(value('amount-in-cents')),
+                    reference: value('reference'),
+                    publicKey: value('public-key'),
+                    redirectUrl: value('redirect-url'),
+                });
+                checkout.open(function (result) {
+                    var transaction = result && result.transaction;
+                    if (!transaction || !transaction.id) {
+                        self.enableButton(button);
+                        return;
+                    }
+                    self._rpc({
+                        route: '/payment/wompicol/widget_return',
+                        params: {
+                            id: transaction.id,
+                            env: value('wompicol-env'),
+                            acquirer_id: value('wompicol-acquirer'),
+                        },
+                    }).then(function () {
+                        return self._wompicolWaitStatus(value('odoo-reference'));
+                    }).then(function () {
+                        window.location = '/payment/process';
+                    });
+                });
+            }).guardedCatch(function () {
+                self.displayError(
+                    _t('Server Error'),
+                    _t("We are not able to open the payment form.")
+                );
+                self.enableButton(button);
+            });
+        },
         _wompicolPayEvent: function (ev) {
             ev.preventDefault();
             var form = this.el;
@@ -148,6 +238,9 @@ odoo.define("payment_wompicol.payment_form", ['web.public.widget', 'payment.paym
                                 newForm.setAttribute("provider", checked_radio.dataset.provider);
                                 newForm.hidden = true; // hide it
                                 newForm.innerHTML = result; // put the html sent by the server inside the form
+                                if ($(newForm).find('input[name="wompicol-mode"]').val() === 'widget') {
+                                    return self._wompicolOpenWidget(newForm, button);
+                                }
                                 var action_url = $(newForm).find('input[name="data_set"]').data('actionUrl');
                                 newForm.setAttribute("action", action_url); // set the action url
                                 $(document.getElementsByTagName('body')[0]).append(newForm); // append the form to the body
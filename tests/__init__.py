@@ -1 +1,2 @@
 from . import test_wompicol
+from . import test_wompicol_bench
@@ -1,11 +1,25 @@
+import base64
+import datetime
+import hashlib
+import io
+import json
 import logging
 import math
+import time
 import lxml
+import requests
+from unittest.mock import patch
 from werkzeug import urls
 
+from odoo.addons.payment.models.payment_acquirer import ValidationError
+from odoo.exceptions import UserError
 from odoo.addons.payment.tests.common import PaymentAcquirerCommon
+from odoo import api, fields, SUPERUSER_ID
 from odoo.tests import tagged
 
+from odoo.addons.payment_wompicol.models import wompicol_client, wompicol_logging, wompicol_metrics
+from odoo.addons.payment_wompicol.models.wompicol_client import WompiColClient
+
 
 _logger = logging.getLogger(__name__)
 class WompicolCommon(PaymentAcquirerCommon):
@@ -62,7 +76,7 @@ class WompicolForm(WompicolCommon):
                 "referenceCode": 'wompi_test_transaction',
                 "redirectUrl": urls.url_join(
                                     base_url,
-                                    '/payment/wompicol/client_return'),
+                                    '/payment/wompicol/%s/client_return' % self.wompicol.id),
                 }
 
         # check form result
@@ -179,3 +193,1100 @@ class WompicolForm(WompicolCommon):
                 tx.acquirer_reference,
                 '01-1532941443-49201',
                 'wompicol: wrong txn_id after receiving a valid event notification')
+
+
+@tagged('post_install', '-at_install', 'wompicol')
+class WompicolOffline(WompicolCommon):
+    """Tests that never reach wompi, the api is mocked or not called,
+    run with the standard tests."""
+
+    def test_30_wompicol_api_client(self):
+        '''Every api call of an environment shares the same pooled client'''
+        client = self.wompicol._get_wompicol_client('test')
+        self.assertIs(
+                client,
+                self.wompicol._get_wompicol_client(),
+                'wompicol: acquirer in test should use the test client')
+        self.assertIsNot(
+                client,
+                self.wompicol._get_wompicol_client('prod'),
+                'wompicol: prod and test should not share a client')
+        self.assertEqual(
+                self.wompicol._get_wompicol_api_url('prod'),
+                'https://production.wompi.co/v1',
+                'wompicol: wrong prod api url')
+        self.assertEqual(
+                self.wompicol._get_wompicol_api_url(),
+                'https://sandbox.wompi.co/v1',
+                'wompicol: wrong test api url')
+        self.assertEqual(
+                client.url('/transactions/1'),
+                'https://sandbox.wompi.co/v1/transactions/1',
+                'wompicol: wrong transaction url')
+
+    def test_40_wompicol_event_queue(self):
+        '''Queued events are processed in order by the cron'''
+        tx = self.env['payment.transaction'].create({
+            'reference': 'wompi_queue_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        wompi_event_post = {
+              "event": "transaction.updated",
+              "data": {
+                "transaction": {
+                    "id": "01-1532941443-49202",
+                    "amount_in_cents": 4490100,
+                    "reference": "wompi_queue_transaction",
+                    "currency": "COP",
+                    "status": "PENDING",
+                  }
+              },
+              "sent_at":  "2018-07-20T16:45:05.000Z",
+              "noconfirm": 1,
+            }
+        Event = self.env['payment.wompicol.event']
+        pending = Event._wompicol_enqueue(wompi_event_post, self.wompicol)
+        wompi_event_post["data"]["transaction"]["status"] = 'APPROVED'
+        approved = Event._wompicol_enqueue(wompi_event_post, self.wompicol)
+
+        # Nothing happens until the queue is drained
+        self.assertEqual(tx.state, 'draft', 'wompicol: queued event processed right away')
+        self.assertEqual(
+                (pending | approved)._wompicol_group_by_transaction(),
+                [[pending.id, approved.id]],
+                'wompicol: events of a transaction should be grouped in order')
+
+        Event._cron_process_queue()
+        self.assertEqual(
+                (pending | approved).mapped('state'),
+                ['done', 'done'],
+                'wompicol: queued events not processed')
+        self.assertEqual(
+                tx.state,
+                'done',
+                'wompicol: wrong state after processing the queued events')
+
+    def test_50_wompicol_event_dedup(self):
+        '''Repeated deliveries of the same event are dropped'''
+        Dedup = self.env['payment.wompicol.dedup']
+        wompi_event_post = {
+              "event": "transaction.updated",
+              "data": {
+                "transaction": {
+                    "id": "01-1532941443-49203",
+                    "status": "APPROVED",
+                  }
+              },
+              "sent_at":  "2018-07-20T16:45:05.000Z",
+            }
+        self.assertTrue(
+                Dedup._wompicol_register_event(wompi_event_post),
+                'wompicol: first delivery of an event should be accepted')
+        self.assertFalse(
+                Dedup._wompicol_register_event(wompi_event_post),
+                'wompicol: repeated delivery of an event should be dropped')
+        # A new status of the same transaction is a new event
+        wompi_event_post["data"]["transaction"]["status"] = 'VOIDED'
+        self.assertTrue(
+                Dedup._wompicol_register_event(wompi_event_post),
+                'wompicol: new status of a transaction should be accepted')
+
+    def test_60_wompicol_event_signature(self):
+        '''Events are validated locally with the events secret'''
+        self.wompicol.write({
+            'wompicol_event_verification': 'signature',
+            'wompicol_test_events_secret': 'test_events_secret',
+        })
+        tx = self.env['payment.transaction'].create({
+            'reference': 'wompi_signed_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        wompi_event_post = {
+              "event": "transaction.updated",
+              "data": {
+                "transaction": {
+                    "id": "01-1532941443-49204",
+                    "amount_in_cents": 4490100,
+                    "reference": "wompi_signed_transaction",
+                    "status": "APPROVED",
+                  }
+              },
+              "signature": {
+                "properties": [
+                    "transaction.id",
+                    "transaction.status",
+                    "transaction.amount_in_cents"
+                ],
+                "checksum": hashlib.sha256(
+                    b'01-1532941443-49204APPROVED44901001530291411test_events_secret'
+                    ).hexdigest().upper(),
+              },
+              "timestamp": 1530291411,
+              "sent_at":  "2018-07-20T16:45:05.000Z",
+              "received_at": 1530291411 + 5,
+            }
+        self.assertTrue(
+                tx._wompicol_confirm_event(wompi_event_post),
+                'wompicol: valid signature not accepted')
+
+        # The same signed event delivered again days later
+        with self.assertRaises(ValidationError):
+            tx._wompicol_confirm_event(dict(wompi_event_post, received_at=1530291411 + 3 * 86400))
+
+        wompi_event_post["data"]["transaction"]["amount_in_cents"] = 100
+        with self.assertRaises(ValidationError):
+            tx._wompicol_confirm_event(wompi_event_post)
+
+    def test_70_wompicol_transaction_cache(self):
+        '''Transaction lookups are shared until the status changes'''
+        calls = []
+
+        def fake_fetch(client, wompi_id):
+            calls.append(wompi_id)
+            return {'id': wompi_id, 'status': 'APPROVED' if len(calls) > 1 else 'PENDING'}
+
+        wompicol_client.transactions_cache.clear()
+        with patch.object(WompiColClient, '_fetch_transaction', autospec=True, side_effect=fake_fetch):
+            data = self.wompicol._wompicol_get_transaction('01-1532941443-49205')
+            data['status'] = 'modified'
+            self.assertEqual(
+                    self.wompicol._wompicol_get_transaction('01-1532941443-49205')['status'],
+                    'PENDING',
+                    'wompicol: cached transaction modified by a caller')
+            self.assertEqual(len(calls), 1, 'wompicol: transaction lookup not cached')
+            # An event says it's approved now, the pending one is stale
+            self.wompicol._wompicol_get_transaction('01-1532941443-49205', status='APPROVED')
+            self.assertEqual(len(calls), 2, 'wompicol: stale transaction not fetched again')
+            self.wompicol._wompicol_get_transaction('01-1532941443-49205', status='APPROVED')
+            self.assertEqual(len(calls), 2, 'wompicol: final transaction not cached')
+        wompicol_client.transactions_cache.clear()
+
+    def test_80_wompicol_status(self):
+        '''The status etag changes only when the transaction changes'''
+        tx = self.env['payment.transaction'].create({
+            'reference': 'wompi_status_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        Tx = self.env['payment.transaction']
+        status = Tx._wompicol_get_status('wompi_status_transaction')
+        self.assertEqual(status['id'], tx.id, 'wompicol: wrong transaction status')
+        self.assertEqual(status['state'], 'draft', 'wompicol: wrong transaction state')
+        self.assertEqual(
+                status['etag'],
+                Tx._wompicol_get_status('wompi_status_transaction')['etag'],
+                'wompicol: etag changed without changes')
+        tx.write({'state': 'pending'})
+        self.assertNotEqual(
+                status['etag'],
+                Tx._wompicol_get_status('wompi_status_transaction')['etag'],
+                'wompicol: etag not changed with the transaction')
+        self.assertIsNone(
+                Tx._wompicol_get_status('wompi_missing_transaction'),
+                'wompicol: status of a missing transaction')
+
+    def test_90_wompicol_circuit_breaker(self):
+        '''The circuit opens after consecutive failures and closes after a probe'''
+        breaker = wompicol_client.CircuitBreaker('test')
+        for i in range(wompicol_client.FAILURE_THRESHOLD):
+            breaker.before_call()
+            breaker.record_failure()
+        self.assertEqual(breaker.state, 'open', 'wompicol: circuit not opened')
+        with self.assertRaises(wompicol_client.CircuitOpenError):
+            breaker.before_call()
+
+        # Once the cooldown passes a single probe goes through
+        breaker.opened_at -= wompicol_client.COOLDOWN
+        breaker.before_call()
+        with self.assertRaises(wompicol_client.CircuitOpenError):
+            breaker.before_call()
+        breaker.record_success(0.1)
+        self.assertEqual(breaker.state, 'closed', 'wompicol: circuit not closed after the probe')
+        breaker.before_call()
+
+        # The read timeout follows the latency
+        for i in range(100):
+            breaker.record_success(1)
+        self.assertEqual(
+                breaker.read_timeout(),
+                wompicol_client.READ_TIMEOUT_FACTOR,
+                'wompicol: read timeout not adapted to the latency')
+
+    def test_100_wompicol_reconcile_pending(self):
+        '''Pending transactions are updated from wompi, with backoff'''
+        Tx = self.env['payment.transaction']
+        approved, pending = [Tx.create({
+            'reference': 'wompi_reconcile_%s' % wompi_id,
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+            'acquirer_reference': wompi_id,
+            'state': 'pending',
+        }) for wompi_id in ('01-1532941443-49206', '01-1532941443-49207')]
+
+        def fake_get_transaction(client, wompi_id, status=None):
+            return {
+                'id': wompi_id,
+                'amount_in_cents': 4490100,
+                'status': 'APPROVED' if wompi_id == approved.acquirer_reference else 'PENDING',
+            }
+
+        with patch.object(WompiColClient, 'get_transaction', autospec=True, side_effect=fake_get_transaction):
+            Tx._cron_wompicol_reconcile_pending()
+        self.assertEqual(approved.state, 'done', 'wompicol: approved transaction not reconciled')
+        self.assertEqual(pending.state, 'pending', 'wompicol: pending transaction modified')
+        self.assertEqual(pending.wompicol_check_count, 1, 'wompicol: pending check not counted')
+        self.assertTrue(pending.wompicol_next_check, 'wompicol: pending next check not scheduled')
+        # Not checked again until the backoff passes
+        self.assertNotIn(
+                pending,
+                Tx.search(Tx._wompicol_reconcile_domain()),
+                'wompicol: pending transaction checked again before the backoff')
+        # Given up after too many checks
+        pending.write({'wompicol_next_check': False})
+        self.assertIn(pending, Tx.search(Tx._wompicol_reconcile_domain()),
+                      'wompicol: due pending transaction not checked')
+        pending.write({'wompicol_check_count': Tx._wompicol_reconcile_params()[2]})
+        self.assertNotIn(pending, Tx.search(Tx._wompicol_reconcile_domain()),
+                         'wompicol: pending transaction checked after too many checks')
+
+        # Drafts only rendered with a wompi reference are looked for a while
+        draft = Tx.create({
+            'reference': 'wompi_reconcile_draft',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+            'wompicol_reference': 'wompi_reconcile_draft_1',
+        })
+        self.assertIn(draft, Tx.search(Tx._wompicol_reconcile_domain()),
+                      'wompicol: recent draft not reconciled')
+        self.assertNotIn(draft, Tx.search(Tx._wompicol_reconcile_domain(draft_max_age=-1)),
+                         'wompicol: abandoned draft reconciled')
+
+    def test_110_wompicol_reference(self):
+        '''The wompi reference finds the transaction without guessing'''
+        Tx = self.env['payment.transaction']
+        decoy = Tx.create({
+            'reference': 'wompi',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        tx = Tx.create({
+            'reference': 'wompi_reference_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        res = self.wompicol.render('wompi_reference_transaction',
+                                   self.amount,
+                                   self.currency_col.id,
+                                   values=self.buyer_values)
+        tree = lxml.etree.fromstring(res)
+        reference = tree.xpath("//input[@name='reference']")[0].get('value')
+        self.assertEqual(
+                tx.wompicol_reference,
+                reference,
+                'wompicol: wompi reference not stored on the transaction')
+        self.assertEqual(
+                Tx._wompicol_search_reference(reference),
+                tx,
+                'wompicol: wrong transaction for the wompi reference')
+        # References of previous attempts still find the transaction
+        self.assertEqual(
+                Tx._wompicol_search_reference('wompi_reference_transaction_1000'),
+                tx,
+                'wompicol: wrong transaction for a previous wompi reference')
+        self.assertEqual(
+                Tx._wompicol_search_reference('wompi_1000'),
+                decoy,
+                'wompicol: wrong transaction for a reference with a suffix')
+
+    def test_120_wompicol_metrics(self):
+        '''Stages of form_feedback are timed and exposed as prometheus text'''
+        wompicol_metrics.reset()
+        self.env['payment.transaction'].create({
+            'reference': 'wompi_metrics_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        self.env['payment.transaction'].form_feedback({
+              "event": "transaction.updated",
+              "data": {
+                "transaction": {
+                    "id": "01-1532941443-49208",
+                    "amount_in_cents": 4490100,
+                    "reference": "wompi_metrics_transaction",
+                    "status": "PENDING",
+                  }
+              },
+              "noconfirm": 1,
+            }, 'wompicol')
+        metrics = wompicol_metrics.render()
+        for stage in ('form_feedback', 'get_tx_from_data', 'validate'):
+            self.assertIn(
+                    'wompicol_stage_seconds_count{stage="%s"} 1' % stage,
+                    metrics,
+                    'wompicol: stage %s not timed' % stage)
+        wompicol_metrics.reset()
+
+    def test_130_wompicol_log_redaction(self):
+        '''Payloads are logged without personal data'''
+        payload = {
+            "event": "transaction.updated",
+            "data": {
+                "transaction": {
+                    "id": "01-1532941443-49201",
+                    "reference": "wompi_test_transaction",
+                    "customer_email": "juan.perez@gmail.com",
+                    "status": "APPROVED",
+                    "merchant": {"phone_number": "+5730000000"},
+                    "status_message": "paid by juan.perez@gmail.com",
+                }
+            },
+        }
+        full = str(wompicol_logging.dump(payload))
+        for private in ('juan.perez@gmail.com', '+5730000000'):
+            self.assertNotIn(private, full, 'wompicol: personal data logged')
+        self.assertIn('01-1532941443-49201', full, 'wompicol: transaction id not logged')
+        summary = str(wompicol_logging.payload(payload))
+        self.assertNotIn('juan.perez', summary, 'wompicol: personal data logged on summary')
+        self.assertIn('status=APPROVED', summary, 'wompicol: status not logged on summary')
+
+    def test_140_wompicol_concurrent_delivery(self):
+        '''Deliveries skip or defer the approval by the lock they get'''
+        # Only the decisions taken on the result of the lock, which is
+        # mocked, the deliveries run one after the other on the test
+        # cursor, test_145 delivers on two cursors at the same time.
+        tx = self.env['payment.transaction'].create({
+            'reference': 'wompi_locked_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        wompi_event_post = {
+              "event": "transaction.updated",
+              "data": {
+                "transaction": {
+                    "id": "01-1532941443-49209",
+                    "amount_in_cents": 4490100,
+                    "reference": "wompi_locked_transaction",
+                    "status": "APPROVED",
+                  }
+              },
+              "noconfirm": 1,
+            }
+        Tx = type(tx)
+        post_processed = []
+
+        def post_process(tx):
+            post_processed.append(tx.id)
+            tx.write({'is_processed': True})
+
+        with patch.object(Tx, '_post_process_after_done', autospec=True, side_effect=post_process):
+            # The other delivery holds the lock, this one is deferred
+            with patch.object(Tx, '_wompicol_lock', autospec=True, return_value=False):
+                tx.form_feedback(wompi_event_post, 'wompicol')
+            self.assertEqual(tx.state, 'draft', 'wompicol: locked transaction updated')
+            deferred = self.env['payment.wompicol.event'].search([
+                ('wompi_id', '=', '01-1532941443-49209')])
+            self.assertEqual(len(deferred), 1, 'wompicol: locked event not deferred')
+
+            # Webhook, client return and the deferred event
+            tx.form_feedback(wompi_event_post, 'wompicol')
+            tx.form_feedback(wompi_event_post, 'wompicol')
+            deferred._wompicol_process()
+
+        self.assertEqual(tx.state, 'done', 'wompicol: approved transaction not done')
+        self.assertEqual(deferred.state, 'done', 'wompicol: deferred event not processed')
+        self.assertEqual(post_processed, [tx.id], 'wompicol: transaction post-processed more than once')
+
+    def _drop_committed(self, tx_id, wompi_id):
+        with self.registry.cursor() as cr:
+            cr.execute("DELETE FROM payment_wompicol_event WHERE wompi_id = %s", (wompi_id,))
+            cr.execute("DELETE FROM payment_transaction WHERE id = %s", (tx_id,))
+
+    def test_145_wompicol_concurrent_cursors(self):
+        '''Only one of two workers delivering an approval post-processes it'''
+        # On committed data, the cursor of the test can't see across
+        wompi_id = '01-1532941443-49250'
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            tx_id = env['payment.transaction'].create({
+                'reference': 'wompi_cursors_transaction',
+                'amount': self.amount,
+                'currency_id': self.currency_col.id,
+                'acquirer_id': self.wompicol.id,
+                'partner_id': env.ref('base.res_partner_1').id,
+            }).id
+        self.addCleanup(self._drop_committed, tx_id, wompi_id)
+        wompi_event_post = {
+              "event": "transaction.updated",
+              "data": {
+                "transaction": {
+                    "id": wompi_id,
+                    "amount_in_cents": 4490100,
+                    "reference": "wompi_cursors_transaction",
+                    "status": "APPROVED",
+                  }
+              },
+              "noconfirm": 1,
+            }
+        Tx = type(self.env['payment.transaction'])
+        post_processed = []
+
+        def post_process(tx):
+            post_processed.append(tx.id)
+            tx.write({'is_processed': True})
+
+        with patch.object(Tx, '_post_process_after_done', autospec=True, side_effect=post_process), \
+                self.registry.cursor() as cr_a, self.registry.cursor() as cr_b:
+            # Fail rather than wait forever on a lock of the test cursor
+            for cr in (cr_a, cr_b):
+                cr.execute("SET LOCAL lock_timeout = '5s'")
+            env_a = api.Environment(cr_a, SUPERUSER_ID, {})
+            env_b = api.Environment(cr_b, SUPERUSER_ID, {})
+            # The first one holds the row until it commits
+            env_a['payment.transaction'].form_feedback(dict(wompi_event_post), 'wompicol')
+            env_a['payment.transaction'].flush()
+            env_b['payment.transaction'].form_feedback(dict(wompi_event_post), 'wompicol')
+            env_b['payment.transaction'].flush()
+            cr_a.commit()
+            cr_b.commit()
+
+            with self.registry.cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                deferred = env['payment.wompicol.event'].search([('wompi_id', '=', wompi_id)])
+                self.assertEqual(len(deferred), 1, 'wompicol: event of the locked transaction not deferred')
+                deferred._wompicol_process()
+                self.assertEqual(deferred.state, 'done', 'wompicol: deferred event not processed')
+                self.assertEqual(env['payment.transaction'].browse(tx_id).state, 'done',
+                                 'wompicol: approved transaction not done')
+        self.assertEqual(post_processed, [tx_id], 'wompicol: transaction post-processed more than once')
+
+    def test_146_wompicol_stale_events(self):
+        '''Late, retried and deferred events never take a transaction back'''
+        Tx = self.env['payment.transaction']
+        tx = Tx.create({
+            'reference': 'wompi_stale_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+
+        def event(status, sent_at):
+            return {
+                "event": "transaction.updated",
+                "data": {"transaction": {
+                    "id": "01-1532941443-49251",
+                    "amount_in_cents": 4490100,
+                    "reference": "wompi_stale_transaction",
+                    "status": status,
+                }},
+                "sent_at": sent_at,
+                "noconfirm": 1,
+            }
+
+        tx.form_feedback(event('APPROVED', '2020-01-01T10:05:00.000Z'), 'wompicol')
+        self.assertEqual(tx.wompicol_event_date, '2020-01-01T10:05:00.000Z', 'wompicol: event date not kept')
+        # The pending sent before, delivered late
+        tx.form_feedback(event('PENDING', '2020-01-01T10:00:00.000Z'), 'wompicol')
+        self.assertEqual(tx.state, 'done', 'wompicol: late pending event took the transaction back')
+        # A pending retried after the approval, through the queue
+        Event = self.env['payment.wompicol.event']
+        queued = Event._wompicol_enqueue(event('PENDING', '2020-01-01T10:10:00.000Z'), self.wompicol)
+        queued._wompicol_process()
+        self.assertEqual((queued.state, tx.state), ('done', 'done'),
+                         'wompicol: queued pending event took the transaction back')
+        # And through the batch
+        result = Tx._wompicol_form_feedback_batch([event('PENDING', '2020-01-01T10:10:00.000Z')])
+        self.assertEqual((result['unchanged'], tx.state), (1, 'done'),
+                         'wompicol: batch pending event took the transaction back')
+
+        # Older events don't undo newer ones, even final ones
+        tx.write({'state': 'pending'})
+        tx.form_feedback(event('DECLINED', '2020-01-01T09:00:00.000Z'), 'wompicol')
+        self.assertEqual(tx.state, 'pending', 'wompicol: older event applied over a newer one')
+
+    def test_150_wompicol_event_retry(self):
+        '''Failed events are retried with backoff, then left as dead letters'''
+        Event = self.env['payment.wompicol.event']
+        # The transaction doesn't exist (yet)
+        event = Event._wompicol_enqueue({
+              "event": "transaction.updated",
+              "data": {
+                "transaction": {
+                    "id": "01-1532941443-49210",
+                    "amount_in_cents": 4490100,
+                    "reference": "wompi_retry_transaction",
+                    "status": "APPROVED",
+                  }
+              },
+              "noconfirm": 1,
+            }, self.wompicol)
+        max_attempts, backoff = Event._wompicol_retry_params()
+
+        Event._cron_process_queue()
+        self.assertEqual(event.state, 'pending', 'wompicol: failed event not kept for retry')
+        self.assertEqual(event.attempts, 1, 'wompicol: failed attempt not counted')
+        self.assertTrue(event.next_attempt, 'wompicol: retry not scheduled')
+        self.assertNotIn(event, Event._wompicol_due_events(100), 'wompicol: event retried before the backoff')
+
+        for i in range(max_attempts - 1):
+            event.next_attempt = False
+            Event._cron_process_queue()
+        self.assertEqual(event.state, 'dead', 'wompicol: event not dead after the max attempts')
+
+        # Once the transaction exists, the event can be re-driven
+        tx = self.env['payment.transaction'].create({
+            'reference': 'wompi_retry_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        event.action_wompicol_redrive()
+        Event._cron_process_queue()
+        self.assertEqual(event.state, 'done', 'wompicol: re-driven event not processed')
+        self.assertEqual(tx.state, 'done', 'wompicol: re-driven event not applied')
+
+        # A worker thread processes its events in one pass, committing
+        # each one, a failed event still holds back the later ones
+        first, second = [Event._wompicol_enqueue({
+              "event": "transaction.updated",
+              "data": {
+                "transaction": {
+                    "id": "01-1532941443-49211",
+                    "amount_in_cents": 4490100,
+                    "reference": "wompi_retry_missing",
+                    "status": status,
+                  }
+              },
+              "noconfirm": 1,
+            }, self.wompicol) for status in ('PENDING', 'APPROVED')]
+        with patch.object(self.env.cr, 'commit') as commit:
+            (first | second)._wompicol_process(commit=True)
+        self.assertEqual(first.attempts, 1, 'wompicol: failed event not counted')
+        self.assertEqual(second.attempts, 0, 'wompicol: later event processed before the failed one')
+        self.assertEqual(commit.call_count, 1, 'wompicol: events not committed one by one')
+
+    def test_160_wompicol_reconciliation(self):
+        '''Wompi transactions are matched against ours, mismatches reported'''
+        Tx = self.env['payment.transaction']
+        values = {
+            'amount': 1000,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        }
+        Tx.create(dict(values, reference='wompi_rec_ok', acquirer_reference='rec-1', state='done'))
+        Tx.create(dict(values, reference='wompi_rec_amount', acquirer_reference='rec-2', state='done'))
+        Tx.create(dict(values, reference='wompi_rec_status', wompicol_reference='wompi_rec_status_1'))
+        missing = Tx.create(dict(values, reference='wompi_rec_missing', acquirer_reference='rec-4', state='done'))
+        # Paid on an earlier attempt, only known by its odoo reference
+        Tx.create(dict(values, reference='wompi_rec_retry', state='done'))
+        # Voided, it stays done
+        Tx.create(dict(values, reference='wompi_rec_voided', acquirer_reference='rec-7', state='done',
+                       wompicol_voided=True))
+        wompi_transactions = [
+            {'id': 'rec-1', 'reference': 'wompi_rec_ok_1', 'amount_in_cents': 100000, 'status': 'APPROVED'},
+            {'id': 'rec-2', 'reference': 'wompi_rec_amount_1', 'amount_in_cents': 200000, 'status': 'APPROVED'},
+            {'id': 'rec-3', 'reference': 'wompi_rec_status_1', 'amount_in_cents': 100000, 'status': 'APPROVED'},
+            {'id': 'rec-5', 'reference': 'unknown_1', 'amount_in_cents': 100000, 'status': 'APPROVED'},
+            {'id': 'rec-6', 'reference': 'wompi_rec_retry_2', 'amount_in_cents': 100000, 'status': 'APPROVED'},
+            {'id': 'rec-7', 'reference': 'wompi_rec_voided_1', 'amount_in_cents': 100000, 'status': 'VOIDED'},
+        ]
+
+        today = fields.Date.today()
+        reconciliation = self.env['payment.wompicol.reconciliation'].create({
+            'acquirer_id': self.wompicol.id,
+            'date_from': today,
+            'date_to': today,
+        })
+        with patch.object(WompiColClient, 'iter_transactions', autospec=True,
+                          return_value=iter(wompi_transactions)):
+            reconciliation.action_run()
+
+        self.assertEqual(reconciliation.wompi_count, 6, 'wompicol: wrong count of wompi transactions')
+        self.assertEqual(reconciliation.matched_count, 3, 'wompicol: wrong count of matched transactions')
+        self.assertEqual(
+                sorted(reconciliation.line_ids.mapped('kind')),
+                ['amount', 'missing_odoo', 'missing_wompi', 'status'],
+                'wompicol: wrong mismatches reported')
+        self.assertEqual(
+                reconciliation.line_ids.filtered(lambda line: line.kind == 'missing_wompi').transaction_id,
+                missing,
+                'wompicol: wrong transaction missing in wompi')
+
+    def test_170_wompicol_settlement_import(self):
+        '''Settlement export lines are matched and their net computed'''
+        Tx = self.env['payment.transaction']
+        values = {
+            'amount': 1000,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+            'state': 'done',
+        }
+        by_id = Tx.create(dict(values, reference='wompi_set_id', acquirer_reference='set-1'))
+        by_ref = Tx.create(dict(values, reference='wompi_set_ref', wompicol_reference='wompi_set_ref_1'))
+        legacy = Tx.create(dict(values, reference='wompi_set_legacy'))
+        export = (
+            'transaction_id;reference;amount_in_cents;fee_in_cents;tax_in_cents\n'
+            'set-1;wompi_set_id_1;100000;2990;568\n'
+            ';wompi_set_ref_1;100000;2990;568\n'
+            'set-3;wompi_set_legacy_7;100000;2990;568\n'
+            'set-4;unknown_1;50000;1000;190\n'
+        )
+
+        settlement = self.wompicol.wompicol_import_settlement(
+                io.BytesIO(export.encode()), 'settlement.csv')
+
+        self.assertEqual(settlement.line_count, 4, 'wompicol: wrong count of settlement lines')
+        self.assertEqual(settlement.matched_count, 3, 'wompicol: wrong count of matched lines')
+        self.assertEqual(settlement.line_ids.mapped('transaction_id'), by_id | by_ref | legacy,
+                         'wompicol: settlement lines matched to the wrong transactions')
+        line = settlement.line_ids[0]
+        self.assertAlmostEqual(line.fee, 29.90, msg='wompicol: wrong settlement fee')
+        self.assertAlmostEqual(line.net, 1000 - 29.90 - 5.68, msg='wompicol: wrong settlement net')
+        self.assertAlmostEqual(settlement.net, 3 * (1000 - 29.90 - 5.68) + (500 - 10 - 1.90),
+                               msg='wompicol: wrong settlement total net')
+
+        # Peso columns in the colombian format, saved by excel with a BOM
+        export = (
+            'id transaccion;referencia;monto;comision;iva\n'
+            'set-1;wompi_set_id_1;1.500.000;45.000;8.550,50\n'
+            'set-4;unknown_1;1,5;0;0\n'
+        )
+        settlement = self.wompicol.wompicol_import_settlement(
+                io.BytesIO(export.encode('utf-8-sig')), 'payout.csv')
+        self.assertEqual(settlement.line_ids[0].transaction_id, by_id,
+                         'wompicol: transaction id column not found after the BOM')
+        self.assertEqual(settlement.line_ids.mapped('amount'), [1500000.0, 1.5],
+                         'wompicol: wrong peso amounts')
+        self.assertAlmostEqual(settlement.line_ids[0].net, 1500000 - 45000 - 8550.50,
+                               msg='wompicol: wrong net of the peso amounts')
+
+        # A bad cell names its line
+        export = (
+            'transaction_id;reference;amount_in_cents\n'
+            'set-1;wompi_set_id_1;100000\n'
+            'set-4;unknown_1;1.000,00\n'
+        )
+        with self.assertRaisesRegex(UserError, 'line 3'):
+            self.wompicol.wompicol_import_settlement(io.BytesIO(export.encode()), 'bad.csv')
+
+        # Not a csv
+        with self.assertRaisesRegex(UserError, 'delimiter'):
+            self.wompicol.wompicol_import_settlement(io.BytesIO(b'%PDF-1.4\n'), 'bad.pdf')
+
+        # The upload of the wizard is decoded as it's read
+        export = 'transaction_id,amount_in_cents\n' + 'set-1,100000\n' * 10000
+        wizard = self.env['payment.wompicol.settlement.import'].create({
+            'acquirer_id': self.wompicol.id,
+            'data': base64.encodebytes(export.encode()),
+            'filename': 'settlement.csv',
+        })
+        settlement = self.env['payment.wompicol.settlement'].browse(wizard.action_import()['res_id'])
+        self.assertEqual(settlement.line_count, 10000, 'wompicol: upload of the wizard not read whole')
+        self.assertEqual(settlement.matched_count, 10000, 'wompicol: wrong count of matched lines')
+
+    def test_180_wompicol_feedback_batch(self):
+        '''A batch of events is applied with a write per target state'''
+        self.wompicol.write({
+            'wompicol_event_verification': 'signature',
+            'wompicol_test_events_secret': 'test_events_secret',
+        })
+        Tx = self.env['payment.transaction']
+        values = {
+            'amount': 1000,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        }
+        approved = Tx.create(dict(values, reference='wompi_batch_1'))
+        pending = Tx.create(dict(values, reference='wompi_batch_2', wompicol_reference='wompi_batch_2_5'))
+        declined = Tx.create(dict(values, reference='wompi_batch_3'))
+
+        def event(wompi_id, reference, status, sent_at):
+            timestamp = int(time.time())
+            checksum = hashlib.sha256(
+                    f"{wompi_id}{status}100000{timestamp}test_events_secret".encode()).hexdigest()
+            return {
+                'event': 'transaction.updated',
+                'data': {'transaction': {
+                    'id': wompi_id, 'reference': reference,
+                    'amount_in_cents': 100000, 'status': status,
+                }},
+                'signature': {
+                    'properties': ['transaction.id', 'transaction.status', 'transaction.amount_in_cents'],
+                    'checksum': checksum,
+                },
+                'timestamp': timestamp,
+                'sent_at': sent_at,
+                'test': 1,
+            }
+
+        events = [
+            event('batch-1', 'wompi_batch_1_3', 'APPROVED', '2020-01-01T10:05:00.000Z'),
+            event('batch-1', 'wompi_batch_1_3', 'PENDING', '2020-01-01T10:00:00.000Z'),
+            event('batch-2', 'wompi_batch_2_5', 'PENDING', '2020-01-01T10:00:00.000Z'),
+            event('batch-3', 'wompi_batch_3_1', 'DECLINED', '2020-01-01T10:00:00.000Z'),
+            event('batch-4', 'wompi_batch_unknown_1', 'APPROVED', '2020-01-01T10:00:00.000Z'),
+        ]
+        with patch.object(type(Tx), 'search', autospec=True, side_effect=type(Tx).search) as search:
+            result = Tx._wompicol_form_feedback_batch(events)
+        reference_searches = [call for call in search.call_args_list
+                              if 'wompicol_reference' in str(call)]
+        self.assertEqual(len(reference_searches), 1, 'wompicol: batch searched the transactions more than once')
+        self.assertEqual(
+                (result['done'], result['pending'], result['cancel'], result['superseded'], result['deferred']),
+                (1, 1, 1, 1, 1),
+                'wompicol: wrong outcome of the batch %s' % result)
+        self.assertEqual(approved.state, 'done', 'wompicol: batch did not apply the last event')
+        self.assertEqual(approved.acquirer_reference, 'batch-1', 'wompicol: batch did not store the wompi id')
+        self.assertEqual(pending.state, 'pending', 'wompicol: batch did not set the pending state')
+        self.assertEqual(declined.state, 'cancel', 'wompicol: batch did not cancel the declined')
+
+        # Delivered again, everything is dropped
+        result = Tx._wompicol_form_feedback_batch(events[2:4])
+        self.assertEqual(result['duplicate'], 2, 'wompicol: batch did not drop the duplicates')
+
+        # Rejected events aren't taken as duplicates when sent again
+        Tx.create(dict(values, reference='wompi_batch_5'))
+        forged = event('batch-5', 'wompi_batch_5_1', 'APPROVED', '2020-01-01T10:00:00.000Z')
+        forged['signature']['checksum'] = 'forged'
+        for i in range(2):
+            result = Tx._wompicol_form_feedback_batch([forged])
+            self.assertEqual((result['failed'], result['duplicate']), (1, 0),
+                             'wompicol: wrong outcome of the rejected event %s' % result)
+
+    def test_190_wompicol_event_replay(self):
+        '''Recorded events are replayed in order, without writing on dry run'''
+        Event = self.env['payment.wompicol.event']
+        tx = self.env['payment.transaction'].create({
+            'reference': 'wompi_replay_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        for status in ('PENDING', 'APPROVED'):
+            Event._wompicol_record({
+                  "event": "transaction.updated",
+                  "data": {
+                    "transaction": {
+                        "id": "01-1532941443-49220",
+                        "amount_in_cents": 4490100,
+                        "reference": "wompi_replay_transaction_1",
+                        "status": status,
+                      }
+                  },
+                }, self.wompicol)
+        now = fields.Datetime.now()
+        window = (now - datetime.timedelta(hours=1), now + datetime.timedelta(hours=1))
+
+        summary = Event._wompicol_replay(*window, dry_run=True, verify=False)
+        self.assertEqual((summary['events'], summary['changed'], summary['errors']), (2, 1, 0),
+                         'wompicol: wrong summary of the dry run %s' % summary)
+        self.assertEqual(summary['diffs'][0]['after']['state'], 'done',
+                         'wompicol: dry run did not compute the final state')
+        self.assertEqual(tx.state, 'draft', 'wompicol: dry run wrote on the transaction')
+
+        Event._wompicol_replay(*window, dry_run=False, verify=False)
+        self.assertEqual(tx.state, 'done', 'wompicol: replay did not apply the events')
+
+    def test_200_wompicol_api_transaction(self):
+        '''Transactions are created through the api with a cached acceptance token'''
+        def acceptance(expires_in):
+            claims = json.dumps({'exp': int(time.time()) + expires_in}).encode()
+            token = 'header.%s.signature' % base64.urlsafe_b64encode(claims).decode().rstrip('=')
+            return {'acceptance_token': token, 'permalink': 'https://wompi.co/terms.pdf'}
+
+        calls = []
+
+        def fake_fetch(client, public_key):
+            calls.append(public_key)
+            return acceptance(3600 if len(calls) == 1 else 60)
+
+        wompicol_client.acceptance_cache.clear()
+        with patch.object(WompiColClient, '_fetch_acceptance', autospec=True, side_effect=fake_fetch):
+            self.wompicol._wompicol_get_acceptance()
+            self.wompicol._wompicol_get_acceptance()
+            self.assertEqual(len(calls), 1, 'wompicol: acceptance token not cached')
+            wompicol_client.acceptance_cache.clear()
+            # About to expire, it's not kept
+            self.wompicol._wompicol_get_acceptance()
+            self.wompicol._wompicol_get_acceptance()
+            self.assertEqual(len(calls), 3, 'wompicol: acceptance token kept until it expired')
+
+        tx = self.env['payment.transaction'].create({
+            'reference': 'wompi_api_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+
+        def fake_create(client, private_key, values):
+            return {'id': '01-1532941443-49230', 'reference': values['reference'],
+                    'amount_in_cents': values['amount_in_cents'], 'currency': 'COP',
+                    'status': 'PENDING'}
+
+        with patch.object(WompiColClient, '_fetch_acceptance', autospec=True, return_value=acceptance(3600)), \
+                patch.object(WompiColClient, 'create_transaction', autospec=True, side_effect=fake_create) as create:
+            tx.wompicol_api_create({'type': 'NEQUI', 'phone_number': '3991111111'})
+        values = create.call_args[0][2]
+        self.assertTrue(values['acceptance_token'], 'wompicol: transaction created without acceptance token')
+        self.assertEqual(values['reference'], tx.wompicol_reference, 'wompicol: wompi reference not kept')
+        self.assertEqual(tx.state, 'pending', 'wompicol: api transaction status not applied')
+        self.assertEqual(tx.acquirer_reference, '01-1532941443-49230', 'wompicol: wompi id not stored')
+        wompicol_client.acceptance_cache.clear()
+
+    def test_210_wompicol_widget_form(self):
+        '''The form carries what the widget needs in widget mode'''
+        self.wompicol.wompicol_payment_mode = 'widget'
+        self.env['payment.transaction'].create({
+            'reference': 'wompi_widget_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id
+        })
+        res = self.wompicol.render('wompi_widget_transaction',
+                                   self.amount,
+                                   self.currency_col.id,
+                                   values=self.buyer_values)
+        tree = lxml.etree.fromstring(res)
+        self.assertEqual(tree.xpath("//input[@name='wompicol-mode']")[0].get('value'), 'widget',
+                         'wompicol: widget mode not rendered')
+        self.assertEqual(tree.xpath("//input[@name='wompicol-env']")[0].get('value'), 'test',
+                         'wompicol: wrong widget environment')
+        self.assertEqual(tree.xpath("//input[@name='odoo-reference']")[0].get('value'),
+                         'wompi_widget_transaction',
+                         'wompicol: odoo reference not rendered for the status polling')
+
+    def test_220_wompicol_void(self):
+        '''Transactions are voided in bulk, each result written back'''
+        limiter = wompicol_client.RateLimiter(rate=100, burst=1)
+        start = time.monotonic()
+        for i in range(5):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.035, 'wompicol: rate limit not respected')
+
+        Tx = self.env['payment.transaction']
+        values = {
+            'amount': 1000,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+            'state': 'done',
+        }
+        voided = Tx.create(dict(values, reference='wompi_void_1', acquirer_reference='void-1'))
+        failed = Tx.create(dict(values, reference='wompi_void_2', acquirer_reference='void-2'))
+        draft = Tx.create(dict(values, reference='wompi_void_3', acquirer_reference='void-3', state='draft'))
+
+        def fake_void(client, private_key, wompi_id, amount_in_cents=None):
+            if wompi_id == 'void-2':
+                raise requests.exceptions.HTTPError('wompi api answered 422')
+            return {'status': 'APPROVED'}
+
+        with patch.object(WompiColClient, 'void_transaction', autospec=True, side_effect=fake_void) as void:
+            results = (voided | failed | draft).wompicol_void()
+        self.assertEqual(void.call_count, 2, 'wompicol: only approved transactions should be voided')
+        self.assertTrue(results[voided.id]['ok'], 'wompicol: void not reported')
+        self.assertFalse(results[failed.id]['ok'], 'wompicol: failed void reported as done')
+        self.assertFalse(results[draft.id]['ok'], 'wompicol: draft transaction voided')
+        self.assertTrue(voided.wompicol_voided, 'wompicol: void not recorded')
+        self.assertEqual(voided.state, 'done', 'wompicol: void changed the state of the transaction')
+        self.assertFalse(failed.wompicol_voided, 'wompicol: failed void recorded')
+        self.assertIn('422', failed.state_message, 'wompicol: void error not written back')
+
+        # Already voided, and partial voids only of a single transaction
+        with patch.object(WompiColClient, 'void_transaction', autospec=True, side_effect=fake_void) as void:
+            results = voided.wompicol_void()
+            self.assertFalse(results[voided.id]['ok'], 'wompicol: transaction voided twice')
+            with self.assertRaises(ValidationError):
+                (voided | failed).wompicol_void(amount=500)
+            failed.wompicol_void(amount=500)
+        self.assertEqual(void.call_args[0][3], 50000, 'wompicol: wrong amount voided')
+
+        # The void event wompi sends afterwards keeps them done
+        def void_event(tx, wompi_id):
+            return {
+                'event': 'transaction.updated',
+                'data': {'transaction': {
+                    'id': wompi_id, 'reference': tx.reference,
+                    'amount_in_cents': 100000, 'status': 'VOIDED',
+                }},
+                'sent_at': '2020-01-01T10:00:00.000Z',
+                'noconfirm': 1,
+            }
+        voided.form_feedback(void_event(voided, 'void-1'), 'wompicol')
+        self.assertEqual((voided.state, voided.wompicol_voided), ('done', True),
+                         'wompicol: void event cancelled the voided transaction')
+        result = Tx._wompicol_form_feedback_batch([void_event(failed, 'void-2')])
+        self.assertEqual(result['voided'], 1, 'wompicol: batch void event not recorded %s' % result)
+        self.assertEqual((failed.state, failed.wompicol_voided), ('done', True),
+                         'wompicol: batch void event cancelled the transaction')
+
+    def test_230_wompicol_acquirer_routing(self):
+        '''Events of the url of an acquirer only reach its transactions'''
+        Acquirer = self.env['payment.acquirer']
+        other = Acquirer.create({
+            'name': 'Wompi Colombia Other Merchant',
+            'provider': 'wompicol',
+            'state': 'test',
+            'wompicol_private_key': 'other',
+            'wompicol_public_key': 'other',
+            'wompicol_test_private_key': 'other',
+            'wompicol_test_public_key': 'other',
+        })
+        self.assertEqual(Acquirer._wompicol_get_acquirer(other.id), other,
+                         'wompicol: new acquirer not routed')
+        self.assertFalse(Acquirer._wompicol_get_acquirer(other.id + 1000),
+                         'wompicol: unknown acquirer routed')
+        self.assertIn('/payment/wompicol/%s/response' % other.id, other.wompicol_event_url,
+                      'wompicol: event url not of the acquirer')
+        self.assertEqual(other._get_keys()[1], 'other', 'wompicol: wrong keys of the acquirer')
+
+        tx = self.env['payment.transaction'].create({
+            'reference': 'wompi_routed_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        data = {
+            "data": {"transaction": {
+                "id": "01-1532941443-49240",
+                "amount_in_cents": 4490100,
+                "reference": "wompi_routed_transaction_1",
+                "status": "APPROVED",
+            }},
+            "acquirer_id": other.id,
+        }
+        with self.assertRaises(ValidationError):
+            tx._wompicol_form_get_tx_from_data(data)
+        data["acquirer_id"] = self.wompicol.id
+        self.assertEqual(tx._wompicol_form_get_tx_from_data(data), tx,
+                         'wompicol: event not routed to the transaction of its acquirer')
+
+        # The client return asks the api of the acquirer of the url
+        Acquirer = type(Acquirer)
+        with patch.object(Acquirer, '_wompicol_get_transaction', autospec=True, return_value=None) as lookup:
+            self.env['payment.transaction']._wompicol_get_data_manually('01-1532941443-49241', 'test', other.id)
+        self.assertEqual(lookup.call_args[0][0], other, 'wompicol: client return asked the wrong acquirer')
+
+        # Client returns are queued as lookups, not run on their own threads
+        Event = self.env['payment.wompicol.event']
+        Tx = self.env['payment.transaction']
+        with patch.object(Acquirer, '_wompicol_get_transaction', autospec=True, return_value=None) as lookup:
+            Tx._wompicol_schedule_data_manually('<script>', 'test', other.id)
+            Tx._wompicol_schedule_data_manually('01-1532941443-49242', 'test', other.id + 1000)
+            self.assertFalse(lookup.called, 'wompicol: invalid client return looked up')
+            Tx._wompicol_schedule_data_manually('01-1532941443-49242', 'test', other.id)
+        lookups = Event.search([('event', '=', 'client_return'), ('wompi_id', '=', '01-1532941443-49242')])
+        self.assertEqual(len(lookups), 1, 'wompicol: client return lookup not queued')
+        self.assertEqual(lookups.state, 'done', 'wompicol: client return lookup not processed')
+        self.assertEqual(lookup.call_args[0][0], other, 'wompicol: queued lookup asked the wrong acquirer')
+
+        # Lookups failing on the api are retried by the queue
+        with patch.object(Acquirer, '_wompicol_get_transaction', autospec=True,
+                          side_effect=requests.exceptions.HTTPError('wompi api answered 503')):
+            Tx._wompicol_schedule_data_manually('01-1532941443-49243', 'test', other.id)
+        failed = Event.search([('event', '=', 'client_return'), ('wompi_id', '=', '01-1532941443-49243')])
+        self.assertEqual((failed.state, failed.attempts), ('pending', 1),
+                         'wompicol: failed client return lookup not kept for retry')
+
+    def test_240_wompicol_token_charges(self):
+        '''Due transactions are charged to their payment sources in a batch'''
+        self.env['ir.config_parameter'].sudo().set_param('payment_wompicol.charge_poll_interval', 0)
+        token = self.wompicol.wompicol_s2s_form_process({
+            'payment_source_id': 3891,
+            'partner_id': self.buyer_id,
+        })
+        self.assertEqual(token.acquirer_ref, '3891', 'wompicol: payment source not saved as token')
+
+        Tx = self.env['payment.transaction']
+        values = {
+            'amount': 1000,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+            'payment_token_id': token.id,
+            'type': 'server2server',
+        }
+        approved = Tx.create(dict(values, reference='wompi_charge_1'))
+        failed = Tx.create(dict(values, reference='wompi_charge_2'))
+        timed_out = Tx.create(dict(values, reference='wompi_charge_4'))
+        charges = []
+
+        def fake_create(client, private_key, values):
+            if values['reference'].startswith('wompi_charge_2'):
+                response = requests.Response()
+                response.status_code = 422
+                raise requests.exceptions.HTTPError('wompi api answered 422', response=response)
+            if values['reference'].startswith('wompi_charge_4'):
+                # Wompi may have taken the charge
+                raise requests.exceptions.ReadTimeout('read timed out')
+            charges.append(dict(values, id='charge-1', status='PENDING'))
+            return {key: charges[-1][key] for key in ('id', 'reference', 'amount_in_cents', 'currency', 'status')}
+
+        def fake_get(client, wompi_id, status=None, fresh=False):
+            return {'id': wompi_id, 'reference': charges[-1]['reference'],
+                    'amount_in_cents': charges[-1]['amount_in_cents'], 'currency': 'COP',
+                    'status': 'APPROVED'}
+
+        wompicol_metrics.reset()
+        with patch.object(WompiColClient, 'get_acceptance', autospec=True,
+                          return_value={'acceptance_token': 'acceptance'}), \
+                patch.object(WompiColClient, 'create_transaction', autospec=True, side_effect=fake_create), \
+                patch.object(WompiColClient, 'get_transaction', autospec=True, side_effect=fake_get) as poll:
+            results = (approved | failed | timed_out).wompicol_charge_tokens()
+
+        self.assertEqual(charges[0]['payment_source_id'], 3891, 'wompicol: charge not made to the payment source')
+        self.assertTrue(poll.call_args[1].get('fresh'), 'wompicol: pending charge polled from the cache')
+        self.assertEqual(results[approved.id]['status'], 'APPROVED', 'wompicol: charge status not polled')
+        self.assertFalse(results[failed.id]['ok'], 'wompicol: failed charge reported as done')
+        self.assertEqual(approved.state, 'done', 'wompicol: charged transaction not done')
+        self.assertEqual(failed.state, 'error', 'wompicol: failed charge not set as error')
+        self.assertEqual(timed_out.state, 'pending', 'wompicol: unknown charge not left to the reconciliation')
+        self.assertIn(timed_out, Tx.search(Tx._wompicol_reconcile_domain()),
+                      'wompicol: unknown charge not reconciled')
+
+        # Never charged twice
+        with patch.object(WompiColClient, 'create_transaction', autospec=True) as create:
+            timed_out.write({'state': 'draft'})
+            results = timed_out.wompicol_charge_tokens()
+        self.assertFalse(create.called, 'wompicol: transaction sent to wompi charged again')
+        self.assertFalse(results[timed_out.id]['ok'], 'wompicol: second charge reported')
+        self.assertIn('wompicol_charge_seconds_count{outcome="APPROVED"} 1', wompicol_metrics.render(),
+                      'wompicol: charge not timed')
+
+        # Only approved and pending charges are a successful s2s payment
+        declined = Tx.create(dict(values, reference='wompi_charge_3'))
+        for status, ok in (('APPROVED', True), ('PENDING', True), ('DECLINED', False)):
+            with patch.object(type(Tx), 'wompicol_charge_tokens', autospec=True,
+                              return_value={declined.id: {'ok': True, 'status': status, 'error': None}}):
+                self.assertEqual(bool(declined.wompicol_s2s_do_transaction()), ok,
+                                 'wompicol: wrong s2s result of a %s charge' % status)
+        # No storefront flow to save cards
+        self.assertNotIn('wompicol', self.wompicol._get_feature_support()['tokenize'],
+                         'wompicol: tokenization advertised without a flow')
@@ -0,0 +1,334 @@
+import base64
+import hashlib
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import requests
+
+from lxml import html
+
+from odoo import sql_db
+from odoo.addons.base.models.assetsbundle import AssetsBundle
+from odoo.tests import tagged, HttpCase
+from odoo.tests.common import HOST, PORT
+
+from odoo.addons.payment_wompicol.models import wompicol_client
+from odoo.addons.payment_wompicol.models.wompicol_client import WompiColClient
+from .test_wompicol import WompicolCommon
+from .wompicol_fake_server import FakeWompiServer
+
+
+_logger = logging.getLogger(__name__)
+
+# Latency of the simulated wompi api, in seconds
+API_LATENCY = 0.05
+
+
+class FakeResponse(object):
+
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def json(self):
+        return self.data
+
+
+@tagged('post_install', '-at_install', '-standard', 'wompicol_bench')
+class WompicolBench(WompicolCommon):
+    """Benchmarks of the wompicol hot path, not run by default,
+    run them with --test-tags wompicol_bench"""
+
+    def _bench(self, name, func, rounds):
+        start = time.perf_counter()
+        for i in range(rounds):
+            func()
+        elapsed = time.perf_counter() - start
+        _logger.info('Wompicol bench: %s: %d rounds in %.3fs, %.3fms per round',
+                     name, rounds, elapsed, elapsed * 1000 / rounds)
+        return elapsed
+
+    def test_10_bench_event_verification(self):
+        '''Event verification with the signature vs with the wompi api'''
+        self.wompicol.write({'wompicol_test_events_secret': 'test_events_secret'})
+        tx = self.env['payment.transaction'].create({
+            'reference': 'wompi_bench_transaction',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+        tx_data = {
+            "id": "01-1532941443-49201",
+            "amount_in_cents": 4490100,
+            "reference": "wompi_bench_transaction",
+            "currency": "COP",
+            "status": "APPROVED",
+        }
+        event = {
+            "event": "transaction.updated",
+            "data": {"transaction": tx_data},
+            "signature": {
+                "properties": [
+                    "transaction.id",
+                    "transaction.status",
+                    "transaction.amount_in_cents"
+                ],
+                "checksum": hashlib.sha256(
+                    b'01-1532941443-49201APPROVED44901001530291411test_events_secret'
+                    ).hexdigest(),
+            },
+            "timestamp": 1530291411,
+            "received_at": 1530291411 + 5,
+            "sent_at":  "2018-07-20T16:45:05.000Z",
+        }
+
+        def fake_get(client, path, **kwargs):
+            time.sleep(API_LATENCY)
+            return FakeResponse({'data': dict(tx_data)})
+
+        rounds = 50
+        with patch.object(WompiColClient, 'get', autospec=True, side_effect=fake_get):
+            self.wompicol.wompicol_event_verification = 'signature'
+            signature = self._bench('signature verification',
+                                    lambda: tx._wompicol_confirm_event(event),
+                                    rounds)
+            self.wompicol.wompicol_event_verification = 'api'
+
+            def confirm_uncached():
+                wompicol_client.transactions_cache.clear()
+                tx._wompicol_confirm_event(event)
+            api = self._bench('api verification (%dms latency)' % (API_LATENCY * 1000),
+                              confirm_uncached,
+                              rounds)
+            cached = self._bench('api verification (cached lookup)',
+                                 lambda: tx._wompicol_confirm_event(event),
+                                 rounds)
+        self.assertLess(signature, api, 'wompicol: signature verification slower than the api')
+        self.assertLess(cached, api, 'wompicol: cached lookup slower than the api')
+
+    def test_20_bench_form_render(self):
+        '''Queries per checkout button render, cold and cached config'''
+        self.env['payment.transaction'].create({
+            'reference': 'wompi_bench_render',
+            'amount': self.amount,
+            'currency_id': self.currency_col.id,
+            'acquirer_id': self.wompicol.id,
+            'partner_id': self.buyer_id,
+        })
+
+        def render():
+            self.wompicol.render('wompi_bench_render',
+                                 self.amount,
+                                 self.currency_col.id,
+                                 values=self.buyer_values)
+
+        def queries(cold):
+            if cold:
+                self.wompicol.clear_caches()
+            self.env.invalidate_all()
+            count = self.cr.sql_log_count
+            render()
+            return self.cr.sql_log_count - count
+
+        render()
+        cold = queries(cold=True)
+        cached = queries(cold=False)
+        _logger.info('Wompicol bench: checkout button render: %d queries cold, %d queries cached',
+                     cold, cached)
+        self._bench('checkout button render (cached config)', render, 100)
+        self.assertLess(cached, cold, 'wompicol: cached config render not saving queries')
+
+    def _bundle_size(self, xmlid):
+        """Bytes of the minified javascript of the bundle, and its files."""
+        files, remains = self.env['ir.qweb']._get_asset_content(xmlid, {})
+        bundle = AssetsBundle(xmlid, files, env=self.env)
+        attachment = bundle.js()
+        return len(base64.b64decode(attachment.datas)) if attachment else 0, files
+
+    def test_30_bench_assets(self):
+        '''Size of the wompicol javascript kept out of the frontend bundle'''
+        size, files = self._bundle_size('payment_wompicol.assets_payment')
+        frontend = 'website.assets_frontend' if self.env.ref(
+            'website.assets_frontend', raise_if_not_found=False) else 'web.assets_frontend'
+        frontend_size, frontend_files = self._bundle_size(frontend)
+        self.assertFalse(
+                [f for f in frontend_files if 'payment_wompicol' in (f.get('url') or '')],
+                'wompicol: javascript still loaded on every frontend page')
+        _logger.info('Wompicol bench: %s is %d bytes minified, %d bytes (%.1f%%) '
+                     'saved on every page without a wompicol payment form',
+                     frontend, frontend_size, size,
+                     100.0 * size / (frontend_size + size) if frontend_size + size else 0)
+
+    def _render_checkout(self, acquirers):
+        return self.env['ir.ui.view'].render_template('payment.payment_tokens_list', {
+            'acquirers': acquirers,
+            'pms': self.env['payment.token'],
+            'partner_id': self.buyer_id,
+            'mode': 'payment',
+            'form_action': '/',
+            'prepare_tx_url': '/',
+            'return_url': '/',
+            'submit_txt': 'Pay',
+            'icon_class': 'fa-lock',
+            'show_manage_btn': False,
+            'bootstrap_formatting': True,
+            'amount': self.amount,
+            'currency': self.currency_col,
+        })
+
+    def test_40_bench_checkout_render(self):
+        '''Cost of the wompicol assets on the render of a checkout page'''
+        other = self.env['payment.acquirer'].create({'name': 'Other', 'provider': 'manual'})
+        with_wompicol = self._render_checkout(self.wompicol | other)
+        scripts = [script for script in html.fromstring(with_wompicol).iter('script')
+                   if 'payment_wompicol.assets_payment' in (script.get('src') or '')]
+        self.assertEqual(len(scripts), 1, 'wompicol: assets not loaded on the checkout page')
+        self.assertIsNotNone(scripts[0].get('defer'),
+                             'wompicol: assets loaded before the deferred frontend bundles')
+        self.assertNotIn('payment_wompicol.assets_payment', self._render_checkout(other).decode(),
+                         'wompicol: assets loaded on a checkout page without wompicol')
+
+        rounds = 100
+        without = self._bench('checkout render without wompicol',
+                              lambda: self._render_checkout(other), rounds)
+        wompicol = self._bench('checkout render with wompicol',
+                               lambda: self._render_checkout(self.wompicol | other), rounds)
+        size, files = self._bundle_size('payment_wompicol.assets_payment')
+        _logger.info('Wompicol bench: checkout page with wompicol, %.3fms more per render, '
+                     '%d deferred bytes of javascript', (wompicol - without) * 1000 / rounds, size)
+
+
+@tagged('post_install', '-at_install', '-standard', 'wompicol_bench')
+class WompicolLoadBench(HttpCase):
+    """Load benchmarks of the event url and the client return against
+    a fake wompi api, run them with --test-tags wompicol_bench
+
+    The test server serves the requests one at a time, all of them on
+    the single test cursor, the calls are fired from several clients
+    but handled serially, so the numbers are the cost of a call plus
+    the time queued behind the others, not the throughput of workers
+    serving them concurrently, measure that against a real server."""
+
+    # Events fired per scenario, and how many clients fire them
+    EVENTS = 50
+    CLIENTS = 8
+
+    def setUp(self):
+        super(WompicolLoadBench, self).setUp()
+        self.wompicol = self.env.ref('payment_wompicol.payment_acquirer_wompicol')
+        self.wompicol.write({
+            'wompicol_test_private_key': 'dummy',
+            'wompicol_test_public_key': 'dummy',
+            'wompicol_test_events_secret': 'test_events_secret',
+            'wompicol_async_events': False,
+            'state': 'test',
+        })
+        self.currency_col = self.env.ref('base.COP')
+        self.partner = self.env.ref('base.res_partner_1')
+        self.base_url = "http://%s:%s" % (HOST, PORT)
+        self.wompi = FakeWompiServer(latency=0.02, seed=42).start()
+        self.addCleanup(self.wompi.stop)
+        patcher = patch.dict(wompicol_client.API_URLS, test=self.wompi.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        wompicol_client.reset_clients()
+        self.addCleanup(wompicol_client.reset_clients)
+
+    def _create_transactions(self, name):
+        """Transactions paid on wompi, known by the fake api."""
+        wompi_ids = []
+        for i in range(self.EVENTS):
+            reference = f"wompi_load_{name}_{i}"
+            wompi_id = f"01-1532941443-{name}-{i}"
+            self.env['payment.transaction'].create({
+                'reference': reference,
+                'wompicol_reference': f"{reference}_1",
+                'amount': 44900,
+                'currency_id': self.currency_col.id,
+                'acquirer_id': self.wompicol.id,
+                'partner_id': self.partner.id,
+            })
+            self.wompi.add_transaction({
+                'id': wompi_id,
+                'amount_in_cents': 4490000,
+                'reference': f"{reference}_1",
+                'currency': 'COP',
+                'status': 'APPROVED',
+            })
+            wompi_ids.append(wompi_id)
+        return wompi_ids
+
+    def _failed(self, response):
+        """Whether the call failed, json routes answer their errors with
+        a 200 and the error in the body."""
+        if response.status_code >= 400:
+            return True
+        if response.headers.get('Content-Type', '').startswith('application/json'):
+            return 'error' in response.json()
+        return False
+
+    def _load(self, name, call, wompi_ids):
+        """Fire the calls from several clients, and report the numbers."""
+        session = requests.Session()
+
+        def timed(wompi_id):
+            start = time.perf_counter()
+            response = call(session, wompi_id)
+            return time.perf_counter() - start, self._failed(response)
+
+        queries = sql_db.sql_counter
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.CLIENTS) as executor:
+            results = list(executor.map(timed, wompi_ids))
+        elapsed = time.perf_counter() - start
+        queries = sql_db.sql_counter - queries
+
+        latencies = sorted(latency for latency, failed in results)
+
+        def percentile(p):
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+        _logger.info(
+            'Wompicol load bench: %s: %d calls from %d clients, served serially, '
+            '%.1f calls/s, p50 %.1fms, p95 %.1fms, p99 %.1fms, %.1f queries per call, '
+            '%d wompi api calls',
+            name, len(results), self.CLIENTS, len(results) / elapsed,
+            percentile(0.5), percentile(0.95), percentile(0.99),
+            queries / len(results), self.wompi.requests)
+        # The client return answers with a redirect
+        self.assertFalse([latency for latency, failed in results if failed],
+                         'wompicol: %s calls failed' % name)
+        return results
+
+    def _event_call(self, events_secret=None):
+        def call(session, wompi_id):
+            return self.wompi.push_event(self.base_url + '/payment/wompicol_test/response',
+                                         wompi_id, events_secret, session=session)
+        return call
+
+    def test_10_load_event_signature(self):
+        '''Events verified with their signature'''
+        self.wompicol.wompicol_event_verification = 'signature'
+        wompi_ids = self._create_transactions('signature')
+        self._load('events (signature)', self._event_call('test_events_secret'), wompi_ids)
+
+    def test_20_load_event_api(self):
+        '''Events verified with the wompi api'''
+        self.wompicol.wompicol_event_verification = 'api'
+        wompi_ids = self._create_transactions('api')
+        self._load('events (api, %dms latency)' % (self.wompi.latency * 1000),
+                   self._event_call(), wompi_ids)
+
+    def test_30_load_client_return(self):
+        '''Client browsers coming back from wompi'''
+        wompi_ids = self._create_transactions('return')
+
+        def call(session, wompi_id):
+            return session.get(self.base_url + '/payment/wompicol/client_return',
+                               params={'id': wompi_id, 'env': 'test'},
+                               allow_redirects=False, timeout=60)
+        self._load('client returns', call, wompi_ids)
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeWompiServer(object):
+    """Stand in for the wompi api on localhost, serves the transactions
+    added to it on /v1/transactions/{id}, and pushes events like wompi
+    does. Latency (seconds) and error_rate (0 to 1, answered with a 503)
+    can be changed at any time.
+
+        with FakeWompiServer(latency=0.05) as wompi:
+            wompi.add_transaction({'id': '1-1-1', 'status': 'APPROVED', ...})
+            with patch.dict(wompicol_client.API_URLS, test=wompi.url):
+                ...
+    """
+
+    def __init__(self, latency=0, error_rate=0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.transactions = {}
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                fake._handle(self)
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='fake_wompi_server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def add_transaction(self, transaction):
+        self.transactions[transaction['id']] = dict(transaction)
+
+    def _answer(self, handler, status, data):
+        body = json.dumps(data).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _handle(self, handler):
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            return self._answer(handler, 503, {'error': {'type': 'SERVICE_UNAVAILABLE'}})
+        match = re.match(r'^/v1/transactions/([^/?]+)$', handler.path)
+        transaction = match and self.transactions.get(match.group(1))
+        if not transaction:
+            return self._answer(handler, 404, {'error': {'type': 'NOT_FOUND_ERROR'}})
+        return self._answer(handler, 200, {'data': transaction, 'meta': {}})
+
+    def event(self, transaction_id, events_secret=None, timestamp=None):
+        """The transaction.updated event of the transaction, signed
+        with the events secret if given."""
+        transaction = self.transactions[transaction_id]
+        timestamp = timestamp or int(time.time())
+        event = {
+            'event': 'transaction.updated',
+            'data': {'transaction': dict(transaction)},
+            'environment': 'test',
+            'sent_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp)),
+            'timestamp': timestamp,
+        }
+        if events_secret:
+            properties = ['transaction.id', 'transaction.status', 'transaction.amount_in_cents']
+            values = ''.join(str(transaction[prop.split('.')[1]]) for prop in properties)
+            event['signature'] = {
+                'properties': properties,
+                'checksum': hashlib.sha256(
+                    f"{values}{timestamp}{events_secret}".encode()).hexdigest().upper(),
+            }
+        return event
+
+    def push_event(self, url, transaction_id, events_secret=None, session=None):
+        """Post the event of the transaction to the url, as wompi does."""
+        return (session or requests).post(
+            url, json=self.event(transaction_id, events_secret), timeout=60)